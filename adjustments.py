@@ -0,0 +1,178 @@
+from collections import OrderedDict
+
+import numpy as np
+
+from vignette import Vignette
+
+# Rec. 601 luma weights of RGB
+LUMA = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+
+class Adjustment:
+    """
+    One stage of an AdjustmentStack, working in place on a float32 RGB buffer in 0 ~ 255.
+    Stages that only scale pixels implement gain instead of apply, AdjustmentStack multiplies
+    neighbouring gains together and applies them in one pass.
+    """
+    name = None
+    neutral = None
+
+    def __init__(self, value=None):
+        self.value = self.neutral if value is None else value
+
+    def is_neutral(self):
+        return self.value == self.neutral
+
+    def gain(self, shape):
+        """
+        :return:
+            a scalar or (h, w, 1) float32 factor, None for stages that aren't a gain.
+        """
+        return None
+
+    def apply(self, buffer):
+        buffer *= self.gain(buffer.shape)
+
+
+class Exposure(Adjustment):
+    """
+    value in stops, +1 doubles the brightness.
+    """
+    name = 'exposure'
+    neutral = 0.
+
+    def gain(self, shape):
+        return np.float32(2. ** self.value)
+
+
+class Saturation(Adjustment):
+    """
+    value 0 is grayscale, 1 leaves the colours alone, larger values exaggerate them.
+    """
+    name = 'saturation'
+    neutral = 1.
+
+    def apply(self, buffer):
+        luma = np.matmul(buffer, LUMA)[..., np.newaxis]
+        luma *= 1 - self.value
+        buffer *= self.value
+        buffer += luma
+
+
+class VignetteAdjustment(Adjustment):
+    """
+    value is the Vignette scale, 2 and above turns it off.
+    """
+    name = 'vignette'
+    neutral = 2.
+
+    def __init__(self, value=None):
+        super().__init__(value)
+        self._vignette = Vignette()
+
+    def is_neutral(self):
+        return self.value >= 1.99
+
+    def gain(self, shape):
+        return self._vignette.mask(shape, self.value)
+
+
+class AdjustmentStack:
+    """
+    Applies adjustments in order. The input of the stage edited last is kept as a snapshot,
+    so moving one slider only recomputes that stage and the ones after it. Runs of gain stages
+    are multiplied into one factor, and the result is clipped and rounded to uint8 once at the end.
+    """
+
+    def __init__(self, adjustments, snapshots=2):
+        """
+        :param snapshots: intermediate float32 images kept, each is 4 times the size of the input.
+        """
+        self.adjustments = OrderedDict((adjustment.name, adjustment) for adjustment in adjustments)
+        self.snapshots = snapshots
+        self._snapshots = OrderedDict()  # stage index -> (input image, values before it, buffer)
+        self._last = None  # (input image, values, result)
+
+    def set(self, name, value):
+        self.adjustments[name].value = value
+
+    def get(self, name):
+        return self.adjustments[name].value
+
+    def values(self):
+        return tuple(adjustment.value for adjustment in self.adjustments.values())
+
+    def is_neutral(self):
+        return all(adjustment.is_neutral() for adjustment in self.adjustments.values())
+
+    def render(self, image):
+        """
+        :param image: RGB uint8 array, treated as unchanged as long as the same object is passed.
+        :return:
+            the adjusted uint8 image, image itself when every stage is neutral.
+        """
+        stages = list(self.adjustments.values())
+        values = self.values()
+        if self._last is not None and self._last[0] is image and self._last[1] == values:
+            return self._last[2]
+        if self.is_neutral():
+            self._last = (image, values, image)
+            return image
+
+        changed = 0
+        if self._last is not None and self._last[0] is image:
+            changed = next(i for i, (old, new) in enumerate(zip(self._last[1], values)) if old != new)
+
+        start, buffer = 0, None
+        for index, (source, before, snapshot) in self._snapshots.items():
+            if source is image and start < index <= changed and before == values[:index]:
+                start, buffer = index, snapshot
+        if buffer is None:
+            buffer = image[:, :, :3].astype(np.float32)
+        else:
+            buffer = buffer.copy()
+            self._snapshots.move_to_end(start)
+
+        if changed > start:
+            self._run(stages[start:changed], buffer)
+            self._keep(changed, image, values[:changed], buffer.copy())
+        self._run(stages[max(start, changed):], buffer)
+        np.clip(buffer, 0, 255, out=buffer)
+        result = buffer.astype(np.uint8)
+        self._last = (image, values, result)
+        return result
+
+    @staticmethod
+    def _run(stages, buffer):
+        gain = None
+        for stage in stages:
+            if stage.is_neutral():
+                continue
+            factor = stage.gain(buffer.shape)
+            if factor is not None:
+                gain = factor if gain is None else gain * factor
+                continue
+            if gain is not None:
+                buffer *= gain
+                gain = None
+            stage.apply(buffer)
+        if gain is not None:
+            buffer *= gain
+
+    def _keep(self, index, image, before, buffer):
+        self._snapshots[index] = (image, before, buffer)
+        self._snapshots.move_to_end(index)
+        while len(self._snapshots) > self.snapshots:
+            self._snapshots.popitem(last=False)
+
+    def copy(self):
+        """
+        :return:
+            a stack with the current values and nothing memoized, for rendering on another thread.
+        """
+        return AdjustmentStack([type(adjustment)(adjustment.value) for adjustment in self.adjustments.values()],
+                               self.snapshots)
+
+    def clear(self):
+        self._snapshots.clear()
+        self._last = None
@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 
+import time
+_STARTED = time.perf_counter()  # baseline of the startup report, taken before the other imports
+
 import sys
-import cv2
 import glob
 import logging
 import numpy as np
@@ -13,15 +15,38 @@ import tkinter.filedialog as filedialog
 from PIL import Image, ImageTk
 import threading as td
 import subprocess
-from threading import RLock
+from collections import OrderedDict
 from PIL.ImageTk import PhotoImage
 
-from enhancer import Enhancer
+from adjustments import AdjustmentStack, Exposure, Saturation, VignetteAdjustment
+from cache import ResultCache
+from encoding import PRESETS, EncoderPool
+from vignette import Vignette, downscale, fit_size
 
 
 # Uncomment the following line if u wanna run it on CPU.
 # os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
 
+# images larger than this are enhanced tile by tile to cap memory usage.
+TILE_SIZE = 2048
+TILE_OVERLAP = 64
+# slider and resize events within this many ms are merged into one repaint.
+REPAINT_DELAY = 40
+# display-scaled copies of the current image kept per canvas size.
+SCALED_CACHE_SIZE = 4
+# smallest proxy worth enhancing before the full resolution pass.
+PROXY_MIN_SIZE = 64
+# inputs are padded to a multiple of this, every new shape costs the session a slow first run.
+BUCKET_SIZE = 128
+# images encoded at the same time when saving.
+ENCODER_WORKERS = 2
+# keep enhanced results on disk across runs in this directory, e.g. os.path.expanduser('~/.cache/fantastic-filter');
+# None keeps them in memory for this session only.
+CACHE_DIR = None
+# the disk cache drops its least recently used results beyond this many bytes.
+CACHE_DISK_SIZE = 4 << 30
+
+
 class APP(tk.Tk):
 
     def __init__(self):
@@ -49,17 +74,24 @@ class APP(tk.Tk):
         self._model_path_obj = tk.StringVar(self)
         self.main_right_model_label = tk.StringVar(self)
         self.main_right_model_label.set("使用模型：<無>")
-        self._vignette_scale = 1
-        self._vignette_should_update = False
-        self._vignette_lock = RLock()
+        self._adjustments = AdjustmentStack([Exposure(), Saturation(), VignetteAdjustment()])
+        self._adjust_job = None
+        self._adjust_source = (None, None, None)  # (source image, canvas size, downscaled source)
+        self._adjusted_preview = None
+        self.save_preset = tk.StringVar(self, value='fast')
+        self._encoder = None
 
         ''' ======== neuronal ========= '''
-        self._model = Enhancer()
+        # created with the first model, importing TensorFlow and OpenCV would hold the window back for seconds.
+        self._model = None
+        self._startup = {'imports': time.perf_counter() - _STARTED}
+        self.startup_report = '--startup-report' in sys.argv[1:]
 
         ''' ===== internal flags ====== '''
-        self._model_loaded = self._model.model_available
+        self._model_loaded = lambda: self._model is not None and self._model.model_available()
         self._image_loaded = lambda: self._main_image_origin is not None
         self.status_text = tk.StringVar(self)
+        self.proxy_preview = tk.BooleanVar(self, value=True)
         self.resize_width = tk.StringVar(self)
         self.resize_width.trace("w", self._resize_width_listener)
         self.resize_height = tk.StringVar(self)
@@ -69,6 +101,9 @@ class APP(tk.Tk):
         self._main_image_origin = None
         self._main_image_current_clean = None
         self._main_image_enhanced = None
+        self._enhanced_is_proxy = False  # the enhanced image is the canvas sized preview, not the full resolution
+        self._full_running = False
+        self._save_after_full = False
 
         ''' ========== theme ========== '''
 
@@ -83,7 +118,6 @@ class APP(tk.Tk):
         ''' ====== configuration ====== '''
 
         self.model_dir = resource_path("pretrained/")
-        self.vignette_handler()
 
     def _show_origin_listener(self, *args):
         if not (self._check_image()): return
@@ -105,7 +139,9 @@ class APP(tk.Tk):
 
     def enhance_listener(self, *args):
         if not (self._check_image() and self._check_model()): return
-        thread = td.Thread(target=self._enhance_task)
+        size = self._enhance_size()
+        proxy_size = self._proxy_size(size) if self.proxy_preview.get() else None
+        thread = td.Thread(target=self._enhance_task, args=(proxy_size or size,))
         self.status_text.set("增強圖片中..")
         self.enhance_pb.start()
         try:
@@ -114,7 +150,26 @@ class APP(tk.Tk):
         except Exception as e:
             logging.warning(str(e))
         thread.start()
-        self._enhance_handler(thread)
+        self._enhance_handler(thread, full_size=size if proxy_size else None)
+
+    def _enhance_size(self):
+        new_height = int(self.resize_height.get() or 0) or 1
+        new_width = int(self.resize_width.get() or 0) or 1
+        return new_width, new_height
+
+    def _proxy_size(self, size):
+        """
+        :return:
+            size scaled down to the canvas, or None if the image already fits.
+        """
+        canvas_width, canvas_height = self.canvas.winfo_width(), self.canvas.winfo_height()
+        width, height = size
+        if width <= canvas_width and height <= canvas_height:
+            return None
+        proxy_width, proxy_height = fit_size((height, width), canvas_width, canvas_height)
+        if proxy_width < PROXY_MIN_SIZE or proxy_height < PROXY_MIN_SIZE:
+            return None
+        return proxy_width, proxy_height
 
     def _resize_height_listener(self, *args):
         if not self._check_image(): return
@@ -143,45 +198,57 @@ class APP(tk.Tk):
         with self.resize_lock:
             self.resizing = False
 
-    def _enhance_task(self):
-        new_height = int(self.resize_height.get())
-        new_width = int(self.resize_width.get())
-        new_height = new_height if new_height is not 0 else 1
-        new_width = new_width if new_width is not 0 else 1
-
-        resize_image = cv2.resize(self._main_image_origin, dsize=(new_width, new_height))
-        resize_image = resize_image[new_height % 8:, new_width % 8:, :]
-        enhance_result = self._model.sample(resize_image, denoise=False)
+    def _enhance_task(self, size):
+        # crop to a multiple of 8 runs in the graph
+        enhance_result = self._model.sample(self._main_image_origin, denoise=False, resize=size, multiple=8)
         if enhance_result is not None:
             self._main_image_enhanced = enhance_result
             self._main_image_current_clean = self._main_image_enhanced
 
-
-    def _enhance_handler(self, thread: td.Thread):
+    def _enhance_handler(self, thread: td.Thread, full_size=None):
+        """
+        :param full_size: set when thread renders a proxy, the full resolution pass is started after it.
+        """
         if thread.is_alive():
-            self.after(100, lambda: self._enhance_handler(thread))
+            self.after(100, lambda: self._enhance_handler(thread, full_size))
         else:
-            self.enhance_pb.stop()
-            self.start_enhance_btn.config(state="normal")
-            self.config(cursor='')
+            self._full_running = False
             if self._model.success:
                 self.show_enhanced_btn.config(state="disabled")
                 self.show_origin_btn.config(state="normal")
-                image = Image.fromarray(np.asarray(self._main_image_enhanced))
-                self.canvas.set_main_image(image)
+                if self._adjustments.is_neutral():
+                    self.canvas.set_main_image(Image.fromarray(np.asarray(self._main_image_enhanced)))
+                else:
+                    self.adjust_handler()
                 self.canvas.request_update()
+                self._enhanced_is_proxy = full_size is not None
+                if full_size is not None:
+                    self.status_text.set("預覽完成，處理全解析度圖片中..")
+                    thread = td.Thread(target=self._enhance_task, args=(full_size,))
+                    self._full_running = True
+                    thread.start()
+                    self._enhance_handler(thread)
+                    return
+
+                self._enhance_done()
                 self.status_text.set("處理完成！")
                 try:
                     subprocess.check_output(["notify-send", "圖片處理完成！", "<b>幻想濾鏡™</b>處理好圖片囉！", "--icon=face-glasses"])
                 except:
                     logging.warning("can't send notification.")
                 self.after(3000, lambda: self.status_text.set("就緒"))
+                if self._save_after_full:
+                    self._save_after_full = False
+                    self.save()
 
             else:
+                # a failed full resolution pass leaves the preview, _enhanced_is_proxy stays set so it isn't saved
+                self._enhance_done()
+                self._save_after_full = False
                 pop_msg.showerror("Something went wrong.. ", "圖片處理失敗！\n多數失敗是由於圖片太大張了，把圖片縮小點試試～")
                 pop_msg.showerror("Something went wrong.. ", self._model.error_log)
 
-                self.status_text.set("處理失敗！")
+                self.status_text.set("全解析度處理失敗，目前只有預覽結果！" if self._enhanced_is_proxy else "處理失敗！")
                 try:
                     subprocess.check_output(["notify-send", "圖片處理失敗！", "<b>幻想濾鏡™</b>圖片處理失敗了QQ", "--icon=face-sad"])
                 except:
@@ -189,6 +256,11 @@ class APP(tk.Tk):
 
                 self.after(3000, lambda: self.status_text.set("就緒"))
 
+    def _enhance_done(self):
+        self.enhance_pb.stop()
+        self.start_enhance_btn.config(state="normal")
+        self.config(cursor='')
+
     def open_image_listener(self, *args):
 
         try:
@@ -260,43 +332,114 @@ class APP(tk.Tk):
 
     def init_model(self, path: str):
         try:
+            if self._model is None:
+                start = time.perf_counter()
+                from enhancer import Enhancer
+
+                if CACHE_DIR:
+                    logging.info("caching results in %s, up to %d MB", CACHE_DIR, CACHE_DISK_SIZE >> 20)
+                self._model = Enhancer(tile_size=TILE_SIZE, tile_overlap=TILE_OVERLAP, buckets=BUCKET_SIZE,
+                                       cache=ResultCache(CACHE_DIR, max_disk_bytes=CACHE_DISK_SIZE))
+                self._startup['import enhancer'] = time.perf_counter() - start
+            start = time.perf_counter()
             self._model.load_model(model_path=path)
+            if 'first model load' not in self._startup:
+                self._startup['first model load'] = time.perf_counter() - start
+                self._report_startup()
         except Exception as e:
             pop_msg.showerror("Something went wrong.. ", "無法載入模型！")
             logging.error(str(e))
 
+    def _window_shown(self):
+        self._startup['window'] = time.perf_counter() - _STARTED
+        self._report_startup()
+
+    def _report_startup(self):
+        """
+        Seconds since launch until the window showed, and the imports and first model load
+        that used to happen before it and now wait for the user to pick a model.
+        """
+        message = "startup: " + ", ".join("%s %.2fs" % item for item in self._startup.items())
+        if self.startup_report:
+            print(message)
+        else:
+            logging.info(message)
+
     def vignette_listener(self, value):
+        self.adjust_listener('vignette', 2. - float(value))
 
-        self._vignette_scale = 2. - float(value)
-        with self._vignette_lock:
-            self._vignette_should_update = True
+    def exposure_listener(self, value):
+        self.adjust_listener('exposure', float(value))
 
-    def vignette_handler(self):
-        with self._vignette_lock:
-            if self._vignette_should_update:
-                logging.info("update vignette")
-                if not self._check_image():
-                    return False
-                else:
-                    if self._vignette_scale >= 1.99:
-                        result_image = self._main_image_current_clean
-                    else:
-                        image = self._main_image_current_clean.copy()
-                        result_image = self.vignette(image, scale=self._vignette_scale)
-                result_image_pil = Image.fromarray(result_image)
-                self.canvas.set_main_image(result_image_pil)
-                self._vignette_should_update = False
+    def saturation_listener(self, value):
+        self.adjust_listener('saturation', float(value))
+
+    def adjust_listener(self, name, value):
+        self._adjustments.set(name, value)
+        if self._adjust_job is None:
+            self._adjust_job = self.after(REPAINT_DELAY, self.adjust_handler)
 
-        self.after(24, self.vignette_handler)
+    def adjust_handler(self):
+        self._adjust_job = None
+        logging.info("update adjustments")
+        if self._check_image():
+            self._adjusted_preview = Image.fromarray(self._render_adjusted(preview=True))
+            self.canvas.set_main_image(self._adjusted_preview)
+
+    def _render_adjusted(self, preview=False):
+        """
+        :param preview: render at the canvas display size instead of full resolution.
+        """
+        image = self._main_image_current_clean
+        if preview:
+            size = (max(1, self.canvas.winfo_width()), max(1, self.canvas.winfo_height()))
+            source, source_size, _ = self._adjust_source
+            if source is not image or source_size != size:
+                # the source itself is kept, an id could be reused by the next image once this one is freed
+                self._adjust_source = (image, size, downscale(image, *size))
+            image = self._adjust_source[2]
+        return self._adjustments.render(image)
 
     def save(self, *args):
         if not self._check_image():
             return
+        if self._enhanced_is_proxy:
+            if not self._full_running:
+                pop_msg.showwarning("Umm..", "全解析度圖片處理失敗，目前只有預覽大小的結果，請重新增強後再儲存")
+                return
+            # the full resolution pass is still running, save once it's done.
+            self._save_after_full = True
+            self.status_text.set("全解析度圖片處理完成後將會儲存..")
+            return
         path = filedialog.asksaveasfilename(initialfile='enhanced', defaultextension='.png',
-                                            filetypes=[("PNG Images", "*.png"), ("JPEG Files", "*.jpg")])
+                                            filetypes=[("PNG Images", "*.png"), ("JPEG Files", "*.jpg"),
+                                                       ("WebP Images", "*.webp")])
         if path:
             image = self.canvas.main_image
-            image.save(path)
+            if image is not None and image is self._adjusted_preview:
+                # rendered at full resolution on the encoder thread, with the slider values of now
+                stack, source = self._adjustments.copy(), self._main_image_current_clean
+                image = lambda: stack.render(source)
+            if self._encoder is None:
+                self._encoder = EncoderPool(workers=ENCODER_WORKERS)
+            self._save_handler(self._encoder.save(image, path, self.save_preset.get()))
+
+    def _save_handler(self, future):
+        if not future.done():
+            done, total = self._encoder.progress()
+            self.status_text.set("儲存中..（%d/%d）" % (done, total))
+            self.after(100, lambda: self._save_handler(future))
+            return
+        try:
+            record = future.result()
+        except Exception as e:
+            logging.error("save failed: %s", e)
+            self.status_text.set("儲存失敗！")
+            pop_msg.showerror("Something went wrong.. ", "圖片儲存失敗！\n" + str(e))
+        else:
+            self.status_text.set("已儲存 %s（%.1f MB，%.2f秒）" % (os.path.basename(record['path']),
+                                                             record['bytes'] / 1e6, record['seconds']))
+        self.after(3000, lambda: self.status_text.set("就緒"))
 
     def run(self):
         '''
@@ -377,6 +520,7 @@ class APP(tk.Tk):
 
         self.enhance_pb = ttk.Progressbar(frame_fantastic, length=160, mode="indeterminate", orient=tk.HORIZONTAL)
         self.enhance_pb.pack(fill='x', pady=5)
+        ttk.Checkbutton(frame_fantastic, text="先顯示快速預覽", variable=self.proxy_preview).pack(fill='x')
 
         ttk.Separator(self.frame_main_right, orient='horizontal').pack(fill='x', pady=10)
 
@@ -395,18 +539,25 @@ class APP(tk.Tk):
 
         ttk.Separator(self.frame_main_right, orient='horizontal').pack(fill='x', pady=10)
 
-        frame_controls_vignette = ttk.Frame(self.frame_main_right)
-        # frame_controls_vignette.pack(fill='x')
+        frame_controls_adjust = ttk.Frame(self.frame_main_right)
+        frame_controls_adjust.pack(fill='x')
 
-        controls_vignette_label = ttk.Label(frame_controls_vignette, text='暈影')
-        controls_vignette_label.pack(fill='x')
-        controls_vignette_scale = ttk.Scale(frame_controls_vignette, length=160, command=self.vignette_listener)
-        controls_vignette_scale.pack(fill='x', ipadx=5)
+        ttk.Label(frame_controls_adjust, text='曝光').pack(fill='x')
+        ttk.Scale(frame_controls_adjust, length=160, from_=-2., to=2., value=0.,
+                  command=self.exposure_listener).pack(fill='x', ipadx=5)
+        ttk.Label(frame_controls_adjust, text='飽和度').pack(fill='x')
+        ttk.Scale(frame_controls_adjust, length=160, from_=0., to=2., value=1.,
+                  command=self.saturation_listener).pack(fill='x', ipadx=5)
+        ttk.Label(frame_controls_adjust, text='暈影').pack(fill='x')
+        ttk.Scale(frame_controls_adjust, length=160, command=self.vignette_listener).pack(fill='x', ipadx=5)
 
-        # ttk.Separator(self.frame_main_right, orient='horizontal').pack(fill='x', pady=10)
+        ttk.Separator(self.frame_main_right, orient='horizontal').pack(fill='x', pady=10)
 
         frame_save = ttk.Frame(self.frame_main_right)
         frame_save.pack(fill='x', pady=10)
+        ttk.Label(frame_save, text='壓縮（速度/大小）').pack(fill='x')
+        ttk.Combobox(frame_save, textvariable=self.save_preset, values=list(PRESETS), state='readonly',
+                     width=9).pack(fill='x', pady=(0, 5))
         ttk.Button(frame_save, text='儲存', command=self.save).pack(fill='x', expand=True)
 
         tk.Grid.rowconfigure(frame_main, 0, weight=1)
@@ -424,38 +575,12 @@ class APP(tk.Tk):
         self.bind_all("<Control-o>", self.open_image_listener)
         self.bind_all("<Command-s>", self.save)
         self.bind_all("<Control-s>", self.save)
+        self.after_idle(self._window_shown)
         self.mainloop()
 
     @staticmethod
     def vignette(image, scale):
-
-        # every numpy array has a shape tuple
-        width, height = image.shape[:2]
-
-        xs = np.arange(width)
-        ys = np.arange(height)
-        distance_squared = (xs - width / 2.0)[..., np.newaxis] ** 2 + (ys - height / 2.0) ** 2
-
-        sigma_squared = (width / 2.0) ** 2 + (height / 2.0) ** 2
-        sigma_squared /= 2
-        mask = np.exp(-distance_squared / sigma_squared)
-
-        # the easiest way to control the strength of the mask
-
-        # the easiest way to control the strength of the mask
-
-        scale_revers = 1 / scale
-
-        new_h = int(mask.shape[0] * scale_revers)
-        new_w = int(mask.shape[1] * scale_revers)
-        y_start = int((mask.shape[0] - new_h) / 2)
-        x_start = int((mask.shape[1] - new_w) / 2)
-
-        mask_new = mask.copy()[x_start:new_h, y_start:new_w]
-        mask_new = cv2.resize(mask_new, (mask.shape[1], mask.shape[0]))
-
-        result = image * mask_new[..., np.newaxis]
-        return np.uint8(result)
+        return Vignette().apply(image, scale)
 
     def _check_model(self):
         if not self._model_loaded():
@@ -490,63 +615,72 @@ def isnumeric_or_blank(my_str: str):
 class ResizingCanvas(tk.Canvas):
     image: PhotoImage
 
-    def __init__(self, parent, **args):
+    def __init__(self, parent, repaint_delay=REPAINT_DELAY, **args):
+        """
+        :param repaint_delay: ms to wait before repainting, requests arriving meanwhile share the repaint.
+        """
         super().__init__(parent, args)
         self.main_image = None
         self.width = self.winfo_width()
         self.height = self.winfo_height()
-        self.lock = RLock()
-        self._should_update = False
+        self.repaint_delay = repaint_delay
+        self._repaint_job = None
+        self._scaled_image = None
+        self._scaled_cache = OrderedDict()
         self.bind("<Configure>", self.on_resize)
-        self._update_handler()
 
         self.main_image_tk = None
         self.image_pi = None
 
-    def _update_handler(self, interval=200):
-        with self.lock:
-            if self._should_update:
-                self.update_now()
-                self._should_update = False
-        self.after(interval, lambda: self._update_handler(interval))
-
     def on_resize(self, event):
         self.request_update()
-        # self.update()
 
     def request_update(self):
-        with self.lock:
-            self._should_update = True
+        if self._repaint_job is None:
+            self._repaint_job = self.after(self.repaint_delay, self.update_now)
 
     def update_now(self, *args):
+        if self._repaint_job is not None:
+            self.after_cancel(self._repaint_job)
+            self._repaint_job = None
         self.width = self.winfo_width()
         self.height = self.winfo_height()
 
         image = self.main_image
-        if image is not None:
+        if image is None:
+            return
+        if self._scaled_image is not image:
+            self._scaled_image = image
+            self._scaled_cache.clear()
+
+        size = (self.width, self.height)
+        image_pi = self._scaled_cache.get(size)
+        if image_pi is None:
             w, h = image.size
             scale = min((self.width / w), (self.height / h))
-            image_resize = image.resize((int(w * scale), (int(h * scale))), Image.ANTIALIAS)
-            self.image_pi = ImageTk.PhotoImage(image=image_resize)
+            image_resize = image.resize((max(1, int(w * scale)), max(1, int(h * scale))), Image.ANTIALIAS)
+            image_pi = ImageTk.PhotoImage(image=image_resize)
+            self._scaled_cache[size] = image_pi
+            while len(self._scaled_cache) > SCALED_CACHE_SIZE:
+                self._scaled_cache.popitem(last=False)
+        else:
+            self._scaled_cache.move_to_end(size)
 
-            # self.delete("all")
+        if image_pi is self.image_pi:
+            self.coords(self.main_image_tk, self.width / 2, self.height / 2)
+            return
+        self.image_pi = image_pi
+        if self.main_image_tk is None:
             self.main_image_tk = self.create_image(self.width / 2, self.height / 2, anchor='center',
                                                    image=self.image_pi)
-            self.image = self.image_pi
-            self.update()
-
-    def set_main_image(self, image: Image):
-
-        if self.image_pi is not None:
-            w, h = image.size
-            scale = min((self.width / w), (self.height / h))
-            image_resize = image.resize((int(w * scale), (int(h * scale))), Image.ANTIALIAS)
-            self.image = image_resize
-            self.image_pi = ImageTk.PhotoImage(image=image_resize)
+        else:
+            self.coords(self.main_image_tk, self.width / 2, self.height / 2)
             self.itemconfigure(self.main_image_tk, image=self.image_pi)
+        self.image = self.image_pi
 
-        # self.image = image
+    def set_main_image(self, image: Image):
         self.main_image = image
+        self.request_update()
 
 
 def resource_path(relative_path):
@@ -0,0 +1,574 @@
+import logging
+import os
+import threading as td
+
+import numpy as np
+
+# tried in this order by 'auto', the first installed one that loads the model and runs a probe image wins.
+# OpenCV starts several times faster than TensorFlow and uses half the memory, but runs convolutions slower,
+# so it's picked when TensorFlow isn't installed or asked for by name.
+CPU_ORDER = ('onnxruntime', 'tflite', 'tensorflow', 'opencv')
+GPU_ORDER = ('tensorflow', 'onnxruntime', 'tflite', 'opencv')
+PROBE_SIZE = 64
+# tensorflow.DataType values of the input types backends handle
+_DTYPES = {1: 'float32', 4: 'uint8', 19: 'float16'}
+
+
+def _varint(data, pos):
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _varint_bytes(value):
+    out = bytearray()
+    while True:
+        byte, value = value & 0x7f, value >> 7
+        if not value:
+            out.append(byte)
+            return bytes(out)
+        out.append(byte | 0x80)
+
+
+def _field(number, payload):
+    """
+    Serialize a length-delimited field.
+    """
+    return _varint_bytes(number << 3 | 2) + _varint_bytes(len(payload)) + payload
+
+
+def _fields(data):
+    """
+    Walk the top level fields of a serialized protobuf message.
+    :return:
+        generator of (field number, int or memoryview value, start offset, end offset)
+    """
+    pos = 0
+    while pos < len(data):
+        start = pos
+        key, pos = _varint(data, pos)
+        number, wire = key >> 3, key & 7
+        if wire == 0:
+            value, pos = _varint(data, pos)
+        elif wire == 1:
+            value, pos = data[pos:pos + 8], pos + 8
+        elif wire == 2:
+            length, pos = _varint(data, pos)
+            value, pos = data[pos:pos + length], pos + length
+        elif wire == 5:
+            value, pos = data[pos:pos + 4], pos + 4
+        else:
+            raise ValueError("unsupported protobuf wire type %d" % wire)
+        yield number, value, start, pos
+
+
+def _node(data):
+    """
+    The name, op, inputs and raw attrs of a serialized NodeDef.
+    """
+    node = {'name': '', 'op': '', 'inputs': [], 'attr': {}}
+    for number, value, _, _ in _fields(data):
+        if number == 1:
+            node['name'] = bytes(value).decode()
+        elif number == 2:
+            node['op'] = bytes(value).decode()
+        elif number == 3:
+            node['inputs'].append(bytes(value).decode())
+        elif number == 5:
+            entry = {field: item for field, item, _, _ in _fields(value)}
+            node['attr'][bytes(entry.get(1, b'')).decode()] = entry.get(2, memoryview(b''))
+    return node
+
+
+def model_signature(model_bytes):
+    """
+    Read what the backends need to know about a frozen model without importing TensorFlow.
+    :return:
+        {'input_dtype': 'float32', 'uint8', ... or None, 'input_rank': int or None,
+         'output_op': op of 'output_image', 'output_source': input of 'output_image'}
+    """
+    signature = {'input_dtype': None, 'input_rank': None, 'output_op': None, 'output_source': None}
+    for number, value, _, _ in _fields(memoryview(model_bytes)):
+        if number != 1:
+            continue
+        node = _node(value)
+        if node['name'] == 'input_image':
+            for field, item, _, _ in _fields(node['attr'].get('dtype', memoryview(b''))):
+                if field == 6:
+                    signature['input_dtype'] = _DTYPES.get(item, str(item))
+            for field, item, _, _ in _fields(node['attr'].get('shape', memoryview(b''))):
+                if field == 7:  # TensorShapeProto, dims are field 2 and unknown_rank field 3
+                    shape = [(part, content) for part, content, _, _ in _fields(item)]
+                    if not any(part == 3 and content for part, content in shape):
+                        signature['input_rank'] = sum(part == 2 for part, _ in shape)
+        elif node['name'] == 'output_image':
+            signature['output_op'] = node['op']
+            signature['output_source'] = node['inputs'][0].split(':')[0] if node['inputs'] else None
+    return signature
+
+
+def strip_output_cast(model_bytes):
+    """
+    Drop the final uint8 Cast some backends can't import, the host rounds the float output instead.
+    :return:
+        (model bytes, name of the node to read the output from)
+    """
+    data = memoryview(model_bytes)
+    for number, value, start, end in _fields(data):
+        if number == 1:
+            node = _node(value)
+            if node['name'] == 'output_image' and node['op'] == 'Cast':
+                return bytes(data[:start]) + bytes(data[end:]), node['inputs'][0].split(':')[0]
+    return bytes(model_bytes), 'output_image'
+
+
+def _const_int(node):
+    """
+    The first element of an integer Const NodeDef, None when it isn't one.
+    """
+    for field, tensor, _, _ in _fields(node['attr'].get('value', memoryview(b''))):
+        if field != 8:  # AttrValue.tensor
+            continue
+        dtype = None
+        for part, content, _, _ in _fields(tensor):
+            if part == 1:
+                dtype = {3: np.int32, 9: np.int64}.get(content)
+            elif part == 4 and dtype is not None and len(content):  # tensor_content
+                return int(np.frombuffer(bytes(content), dtype=dtype)[0])
+            elif part == 7:  # int_val, packed or not
+                value = content if isinstance(content, int) else _varint(content, 0)[0]
+                return value - (1 << 64) if value >= 1 << 63 else value
+    return None
+
+
+def _rewrite_node(data, inputs, drop_attrs=()):
+    """
+    Serialize a NodeDef again with new inputs and without some attrs, other fields are copied as they are.
+    """
+    parts = []
+    for number, value, start, end in _fields(data):
+        if number == 3:
+            continue
+        if number == 5 and bytes(dict((f, v) for f, v, _, _ in _fields(value)).get(1, b'')).decode() in drop_attrs:
+            continue
+        parts.append(bytes(data[start:end]))
+    return b''.join(parts) + b''.join(_field(3, name.encode()) for name in inputs)
+
+
+def batch_input(model_bytes):
+    """
+    Turn a model following the readme's (h, w, 3) input contract, which expands the image to a batch
+    of one, into one taking the (n, h, w, 3) batch directly: the ExpandDims is dropped and its consumers
+    read 'input_image' instead. Importers like OpenCV's can't handle the ExpandDims of an unknown shape.
+    :return:
+        model bytes.
+    """
+    data = memoryview(model_bytes)
+    nodes = [(_node(value), start, end) for number, value, start, end in _fields(data) if number == 1]
+    by_name = {node['name']: node for node, _, _ in nodes}
+    consumers = [node for node, _, _ in nodes if any(name.split(':')[0] == 'input_image' for name in node['inputs'])]
+    if not consumers or any(node['op'] != 'ExpandDims' for node in consumers):
+        raise ValueError("the (h, w, 3) input isn't only expanded to a batch, it can't be batched")
+    for node in consumers:
+        axis = by_name.get(node['inputs'][1].split(':')[0]) if len(node['inputs']) > 1 else None
+        if axis is None or _const_int(axis) not in (0, -4):
+            raise ValueError("'%s' doesn't expand the input at axis 0" % node['name'])
+    expanded = {node['name'] for node in consumers}
+
+    out, pos = [], 0
+    for number, value, start, end in _fields(data):
+        if number != 1:
+            continue
+        node = _node(value)
+        out.append(bytes(data[pos:start]))
+        pos = end
+        if node['name'] in expanded:
+            continue
+        if node['name'] == 'input_image':
+            # the rank 3 shape would be checked against the batch, leave it unknown
+            rewritten = _rewrite_node(value, node['inputs'], ('shape', '_output_shapes'))
+        elif any(name.split(':')[0] in expanded for name in node['inputs']):
+            inputs = ['input_image' if name.split(':')[0] in expanded else name for name in node['inputs']]
+            rewritten = _rewrite_node(value, inputs)
+        else:
+            out.append(bytes(data[start:end]))
+            continue
+        out.append(_field(1, rewritten))
+    out.append(bytes(data[pos:]))
+    return b''.join(out)
+
+
+def _installed(module):
+    import importlib.util
+
+    try:
+        return importlib.util.find_spec(module) is not None
+    except ValueError:  # already imported without a spec
+        return True
+
+
+def _to_uint8(images):
+    if images.dtype == np.uint8:
+        return images
+    return np.clip(images, 0, 255).astype(np.uint8)  # truncates like the Cast it replaces
+
+
+class Backend:
+    """
+    Runs a frozen model on (n, h, w, 3) uint8 batches. Resizing, cropping, padding and channel order
+    are part of run, see Enhancer._run_batch.
+    """
+    name = None
+
+    def __init__(self, model_bytes, model_path=None, intra_op_threads=0, inter_op_threads=0):
+        self.shapes = set()  # (height, width) the backend has run, see Enhancer.load_model
+
+    @staticmethod
+    def available():
+        """
+        :return:
+            whether the runtime is installed, checked without importing it when possible.
+        """
+        return True
+
+    def run(self, images, size=None, multiple=1, pad_height=0, pad_width=0, bgr_in=False, bgr_out=False,
+            trace=None):
+        """
+        :param images: (n, h, w, 3) uint8.
+        :param size: (width, height) to resize to first.
+        :param multiple: crop the top and left so both sides are a multiple of it.
+        :param pad_height, pad_width: mirror the bottom and right edges by this much and crop the result back.
+        :param bgr_in: images are BGR.
+        :param bgr_out: return BGR.
+        :param trace: called with the run metadata of traced calls, backends that can't trace ignore it.
+        :return:
+            (n, h, w, 3) uint8.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class TensorFlowBackend(Backend):
+    """
+    A TF1 session, the optional steps of run are part of the graph and fed through placeholders.
+    """
+    name = 'tensorflow'
+
+    @staticmethod
+    def available():
+        return _installed('tensorflow')
+
+    def __init__(self, model_bytes, model_path=None, intra_op_threads=0, inter_op_threads=0):
+        import tensorflow as tf  # imported on the first load so importing this module stays fast
+
+        super().__init__(model_bytes)
+        graph = tf.Graph()
+        with graph.as_default():
+            self.image_ph = tf.placeholder(dtype=tf.uint8, shape=(None, None, None, 3), name="ph")
+            # optional pre- and postprocessing, the defaults leave the images as they are.
+            self.height = tf.placeholder_with_default(0, shape=(), name="height")
+            self.width = tf.placeholder_with_default(0, shape=(), name="width")
+            self.multiple = tf.placeholder_with_default(1, shape=(), name="multiple")
+            self.pad_height = tf.placeholder_with_default(0, shape=(), name="pad_height")
+            self.pad_width = tf.placeholder_with_default(0, shape=(), name="pad_width")
+            self.bgr_in = tf.placeholder_with_default(False, shape=(), name="bgr_in")
+            self.bgr_out = tf.placeholder_with_default(False, shape=(), name="bgr_out")
+
+            images = tf.cond(self.bgr_in, lambda: tf.reverse(self.image_ph, [3]), lambda: self.image_ph)
+            shape = tf.shape(images)
+            height = tf.where(self.height > 0, self.height, shape[1])
+            width = tf.where(self.width > 0, self.width, shape[2])
+            resized = lambda: tf.cast(tf.clip_by_value(tf.round(tf.image.resize_bilinear(
+                images, tf.stack([height, width]), half_pixel_centers=True)), 0, 255), dtype=tf.uint8)
+            images = tf.cond(tf.logical_or(tf.not_equal(height, shape[1]), tf.not_equal(width, shape[2])),
+                             resized, lambda: images)
+            images = images[:, height % self.multiple:, width % self.multiple:]
+
+            graph_def = tf.GraphDef()
+            graph_def.ParseFromString(model_bytes)
+
+            if _input_dtype(graph_def) == tf.uint8:
+                # normalization already folded into the model by optimizer.py
+                input_image = images
+            else:
+                input_image = tf.cast(images, dtype=tf.float32)
+                input_image = input_image / 127.5 - 1
+            paddings = [[0, 0], [0, self.pad_height], [0, self.pad_width], [0, 0]]
+            input_image = tf.pad(input_image, paddings, mode='SYMMETRIC')
+
+            output_image = _import_batched(graph_def, input_image)
+            output_shape = tf.shape(output_image)
+            output_image = output_image[:, :output_shape[1] - self.pad_height, :output_shape[2] - self.pad_width]
+            self.output_image = tf.cond(self.bgr_out, lambda: tf.reverse(output_image, [3]), lambda: output_image)
+            config = tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+                                    inter_op_parallelism_threads=inter_op_threads)
+            config.gpu_options.allow_growth = True
+            self.sess = tf.Session(graph=graph, config=config)
+
+    def run(self, images, size=None, multiple=1, pad_height=0, pad_width=0, bgr_in=False, bgr_out=False,
+            trace=None):
+        feed_dict = {self.image_ph: images}
+        for placeholder, value, default in ((self.width, size and size[0], None),
+                                            (self.height, size and size[1], None),
+                                            (self.multiple, multiple, 1),
+                                            (self.pad_height, pad_height, 0),
+                                            (self.pad_width, pad_width, 0),
+                                            (self.bgr_in, bgr_in, False),
+                                            (self.bgr_out, bgr_out, False)):
+            if value != default:
+                feed_dict[placeholder] = value
+
+        options, run_metadata = None, None
+        if trace is not None:
+            import tensorflow as tf
+
+            options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+            run_metadata = tf.RunMetadata()
+
+        [result_imgs] = self.sess.run([self.output_image], feed_dict=feed_dict,
+                                      options=options, run_metadata=run_metadata)
+        if run_metadata is not None:
+            trace(run_metadata)
+        return result_imgs
+
+    def close(self):
+        self.sess.close()
+
+
+class HostBackend(Backend):
+    """
+    Base of the backends running the optional steps of run with NumPy and OpenCV around the model.
+    Subclasses set input_dtype and input_rank and implement _infer.
+    """
+    input_dtype = 'float32'
+    input_rank = 4
+
+    def run(self, images, size=None, multiple=1, pad_height=0, pad_width=0, bgr_in=False, bgr_out=False,
+            trace=None):
+        import cv2
+
+        _, h, w, _ = images.shape
+        width, height = size or (w, h)
+        if bgr_in:
+            images = images[..., ::-1]
+        if (width, height) != (w, h):
+            images = np.stack([cv2.resize(image, (width, height), interpolation=cv2.INTER_LINEAR)
+                               for image in images])
+        images = images[:, height % multiple:, width % multiple:]
+
+        if self.input_dtype == 'uint8':
+            batch = images
+        else:
+            batch = np.multiply(images, np.float32(1 / 127.5), dtype=np.float32)
+            batch -= 1
+        if pad_height or pad_width:
+            batch = np.pad(batch, ((0, 0), (0, pad_height), (0, pad_width), (0, 0)), mode='symmetric')
+        batch = np.ascontiguousarray(batch, dtype=self.input_dtype)
+
+        if self.input_rank == 3:
+            result_imgs = np.stack([_to_uint8(self._infer(image)).reshape(image.shape) for image in batch])
+        else:
+            result_imgs = _to_uint8(self._infer(batch))
+        result_imgs = result_imgs[:, :result_imgs.shape[1] - pad_height, :result_imgs.shape[2] - pad_width]
+        return result_imgs[..., ::-1] if bgr_out else result_imgs
+
+    def _infer(self, batch):
+        """
+        :param batch: the model input, (n, h, w, 3) or (h, w, 3) depending on input_rank.
+        :return:
+            the model output in the same layout, uint8 or float in 0 ~ 255.
+        """
+        raise NotImplementedError
+
+
+class OpenCVBackend(HostBackend):
+    """
+    The frozen .pb through cv2.dnn, no TensorFlow needed. OpenCV imports float32 inputs only, and
+    not every op, so 'auto' falls back for others; (h, w, 3) inputs are rewritten by batch_input.
+    """
+    name = 'opencv'
+
+    def __init__(self, model_bytes, model_path=None, intra_op_threads=0, inter_op_threads=0):
+        import cv2
+
+        super().__init__(model_bytes)
+        signature = model_signature(model_bytes)
+        if signature['input_dtype'] not in (None, 'float32') or signature['input_rank'] not in (3, 4):
+            raise ValueError("OpenCV only imports models with a (h, w, 3) or (n, h, w, 3) float32 input")
+        if signature['input_rank'] == 3:
+            model_bytes = batch_input(model_bytes)
+        model_bytes, self._output = strip_output_cast(model_bytes)
+        self._net = cv2.dnn.readNetFromTensorflow(np.frombuffer(model_bytes, dtype=np.uint8))
+        if intra_op_threads:
+            cv2.setNumThreads(intra_op_threads)
+        self._lock = td.Lock()  # a Net isn't safe to run from several threads
+
+    def _infer(self, batch):
+        with self._lock:
+            self._net.setInput(batch.transpose(0, 3, 1, 2))
+            output = self._net.forward(self._output)
+        return output.transpose(0, 2, 3, 1)
+
+
+class OnnxRuntimeBackend(HostBackend):
+    """
+    ONNX Runtime on the .onnx file next to the .pb (for example converted with tf2onnx).
+    """
+    name = 'onnxruntime'
+
+    def __init__(self, model_bytes, model_path=None, intra_op_threads=0, inter_op_threads=0):
+        import onnxruntime
+
+        super().__init__(model_bytes)
+        path = _sibling(model_path, '.onnx')
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        self._session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        model_input = self._session.get_inputs()[0]
+        self._input = model_input.name
+        self.input_dtype = 'uint8' if model_input.type == 'tensor(uint8)' else 'float32'
+        self.input_rank = len(model_input.shape)
+
+    @staticmethod
+    def available():
+        return _installed('onnxruntime')
+
+    def _infer(self, batch):
+        return self._session.run(None, {self._input: batch})[0]
+
+
+class TFLiteBackend(HostBackend):
+    """
+    The TensorFlow Lite interpreter of tflite_runtime (or its successor ai_edge_litert)
+    on the .tflite file next to the .pb.
+    """
+    name = 'tflite'
+
+    def __init__(self, model_bytes, model_path=None, intra_op_threads=0, inter_op_threads=0):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from ai_edge_litert.interpreter import Interpreter
+
+        super().__init__(model_bytes)
+        self._interpreter = Interpreter(model_path=_sibling(model_path, '.tflite'),
+                                        num_threads=intra_op_threads or None)
+        details = self._interpreter.get_input_details()[0]
+        self._input = details['index']
+        self._output = self._interpreter.get_output_details()[0]['index']
+        self.input_dtype = np.dtype(details['dtype']).name
+        self.input_rank = len(details['shape'])
+        self._shape = None
+        self._lock = td.Lock()  # the interpreter holds one set of tensors
+
+    @staticmethod
+    def available():
+        return _installed('tflite_runtime') or _installed('ai_edge_litert')
+
+    def _infer(self, batch):
+        with self._lock:
+            if batch.shape != self._shape:
+                self._interpreter.resize_tensor_input(self._input, batch.shape, strict=False)
+                self._interpreter.allocate_tensors()
+                self._shape = batch.shape
+            self._interpreter.set_tensor(self._input, batch)
+            self._interpreter.invoke()
+            return self._interpreter.get_tensor(self._output).copy()
+
+
+BACKENDS = {backend.name: backend for backend in (TensorFlowBackend, OpenCVBackend, OnnxRuntimeBackend,
+                                                    TFLiteBackend)}
+
+
+def _sibling(model_path, extension):
+    path = os.path.splitext(model_path or '')[0] + extension
+    if not os.path.exists(path):
+        raise IOError("no '%s' next to the model" % path)
+    return path
+
+
+def _probe(backend):
+    images = np.zeros((1, PROBE_SIZE, PROBE_SIZE, 3), dtype=np.uint8)
+    result = backend.run(images)
+    if result.shape != images.shape:
+        raise ValueError("probe image came back as %s" % (result.shape,))
+    backend.shapes.add((PROBE_SIZE, PROBE_SIZE))
+
+
+def load_backend(model_bytes, model_path=None, backend='auto', gpu=False, intra_op_threads=0, inter_op_threads=0):
+    """
+    :param backend: name from BACKENDS, or 'auto' to try CPU_ORDER or GPU_ORDER and keep the first
+        backend that loads the model and runs a probe image.
+    :return:
+        a loaded Backend.
+    """
+    if backend != 'auto':
+        if backend not in BACKENDS:
+            raise ValueError("unknown backend '%s', expected auto or one of %s" % (backend, ', '.join(BACKENDS)))
+        return BACKENDS[backend](model_bytes, model_path, intra_op_threads, inter_op_threads)
+
+    errors = []
+    for name in GPU_ORDER if gpu else CPU_ORDER:
+        if not BACKENDS[name].available():
+            continue
+        model = None
+        try:
+            model = BACKENDS[name](model_bytes, model_path, intra_op_threads, inter_op_threads)
+            if name != 'tensorflow':  # the reference, a failure there is the model's
+                _probe(model)
+        except Exception as e:
+            if model is not None:
+                model.close()
+            if name == 'tensorflow':
+                raise
+            logging.info("backend %s can't run the model: %s", name, e)
+            errors.append("%s: %s" % (name, e))
+            continue
+        logging.info("running '%s' on %s", model_path, name)
+        return model
+    raise ValueError("no backend can run the model (%s)" % '; '.join(errors))
+
+
+def _input_rank(graph_def):
+    for node in graph_def.node:
+        if node.name == 'input_image' and 'shape' in node.attr and not node.attr['shape'].shape.unknown_rank:
+            return len(node.attr['shape'].shape.dim)
+    return None
+
+
+def _input_dtype(graph_def):
+    import tensorflow as tf
+
+    for node in graph_def.node:
+        if node.name == 'input_image' and 'dtype' in node.attr:
+            return tf.as_dtype(node.attr['dtype'].type)
+    return None
+
+
+def _import_batched(graph_def, input_images):
+    """
+    Import the model so it maps a (n, h, w, 3) batch to a (n, h, w, 3) uint8 batch.
+    Models taking a single (h, w, 3) image are looped over the batch inside the graph,
+    so the whole batch still costs one session call.
+    """
+    import tensorflow as tf
+
+    def enhance(images):
+        [output_image] = tf.import_graph_def(graph_def,
+                                             input_map={'input_image': images},
+                                             return_elements=['output_image:0'],
+                                             name='output')
+        return output_image
+
+    if _input_rank(graph_def) == 4:
+        return enhance(input_images)
+    return tf.map_fn(lambda image: tf.reshape(enhance(image), tf.shape(image)), input_images,
+                     dtype=tf.uint8, back_prop=False)
@@ -0,0 +1,273 @@
+import itertools
+import json
+import multiprocessing as mp
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from denoise import denoise_image
+from encoding import cv2_params
+
+STAGES = ('decode', 'color', 'denoise', 'inference', 'denoise_after', 'encode')
+DENOISE_MODES = ('none', 'before', 'after', 'both')
+
+
+def make_synthetic_model(path, channels=16, seed=0):
+    """
+    Write a small frozen graph honouring the model contract in readme.md:
+    'input_image' (n, m, 3) float32 in -1 ~ +1, 'output_image' (1, n, m, 3) uint8.
+    Two 3x3 convolutions, enough to stand in for a real model without a pretrained file or a GPU.
+    """
+    import tensorflow as tf
+
+    rng = np.random.RandomState(seed)
+    graph = tf.Graph()
+    with graph.as_default():
+        image = tf.placeholder(dtype=tf.float32, shape=(None, None, 3), name='input_image')
+        x = tf.expand_dims(image, 0)
+        kernel = tf.constant(rng.normal(0, 0.2, (3, 3, 3, channels)).astype(np.float32))
+        x = tf.nn.relu(tf.nn.conv2d(x, kernel, strides=[1, 1, 1, 1], padding='SAME'))
+        kernel = tf.constant(rng.normal(0, 0.2, (3, 3, channels, 3)).astype(np.float32))
+        x = tf.tanh(tf.nn.conv2d(x, kernel, strides=[1, 1, 1, 1], padding='SAME'))
+        tf.cast((x + 1) * 127.5, dtype=tf.uint8, name='output_image')
+
+    with open(path, 'wb') as f:
+        f.write(graph.as_graph_def().SerializeToString())
+    return path
+
+
+def synthetic_image(width, height, seed=0):
+    """
+    Smooth gradients plus mild noise, closer to a photo than pure noise so denoise timings are realistic.
+    """
+    rng = np.random.RandomState(seed)
+    ys, xs = np.mgrid[0:height, 0:width].astype(np.float32)
+    image = np.stack([xs / max(1, width - 1), ys / max(1, height - 1), 0.5 + 0 * xs], axis=-1) * 200
+    image += rng.normal(0, 12, image.shape)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def _peak_memory(model_path, backend, gpu, intra, inter, width, height):
+    try:
+        import resource
+    except ImportError:  # not Unix
+        return None
+    from enhancer import Enhancer
+
+    enhancer = Enhancer(gpu=gpu, intra_op_threads=intra, inter_op_threads=inter, backend=backend)
+    enhancer.load_model(model_path)
+    enhancer.sample(synthetic_image(width, height))
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1e6 if sys.platform == 'darwin' else peak / 1024  # bytes on macOS, KB elsewhere
+
+
+def peak_memory(model_path, backend='tensorflow', gpu=False, intra_op_threads=0, inter_op_threads=0,
+                size=(1024, 1024)):
+    """
+    Load the model and enhance one image of size in a fresh process, so backends loaded before don't count.
+    :return:
+        peak resident memory of that process in MB, None where it can't be measured.
+    """
+    with mp.get_context('spawn').Pool(1) as pool:
+        return pool.apply(_peak_memory, (model_path, backend, gpu, intra_op_threads, inter_op_threads) + tuple(size))
+
+
+def _summary(samples):
+    samples = sorted(samples)
+    return {
+        'median': statistics.median(samples),
+        'mean': statistics.mean(samples),
+        'min': samples[0],
+        'p90': samples[min(len(samples) - 1, int(len(samples) * 0.9))],
+    }
+
+
+def run_case(enhancer, width, height, batch_size, denoise, repeat, denoise_preset='standard', encode_preset=None,
+             encode_format='.png'):
+    """
+    Time every stage of enhancing one image the way batch_process does it without a cache or tiles:
+    unless it is denoised first, the decoded BGR image goes to the backend as it is and color conversion
+    and cropping run there, so 'color' stays at zero.
+    Inference is timed per batch and divided by batch_size.
+    :param encode_preset: name from encoding.PRESETS the result is encoded with, None for OpenCV's defaults.
+    :return:
+        ({stage: [seconds per image, ...]} with one entry per repetition, encoded size in bytes)
+    """
+    encoded = cv2.imencode('.png', synthetic_image(width, height))[1]
+    timings = {stage: [] for stage in STAGES + ('total',)}
+    params = cv2_params(encode_format, encode_preset)
+    encoded_bytes = 0
+    denoise_before = denoise in ('before', 'both')
+    denoise_after = denoise in ('after', 'both')
+
+    for _ in range(repeat):
+        times = dict.fromkeys(STAGES, 0.)
+        start = time.perf_counter()
+        image = cv2.imdecode(encoded, cv2.IMREAD_COLOR)
+        times['decode'] = time.perf_counter() - start
+
+        if denoise_before:
+            start = time.perf_counter()
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+            times['color'] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            image = denoise_image(image, denoise_preset)
+            times['denoise'] = time.perf_counter() - start
+
+            h, w, _ = image.shape
+            image = image[h % 4:, w % 4:, :]
+            preprocess = {}
+        else:
+            preprocess = {'multiple': 4, 'bgr_in': True, 'bgr_out': not denoise_after}
+        batch = np.stack([image] * batch_size)
+        start = time.perf_counter()
+        result_img = enhancer.enhance_batch(batch, **preprocess)[0]
+        times['inference'] = (time.perf_counter() - start) / batch_size
+
+        if denoise_after:
+            start = time.perf_counter()
+            result_img = denoise_image(result_img, denoise_preset)
+            times['denoise_after'] = time.perf_counter() - start
+
+        if not preprocess.get('bgr_out'):
+            start = time.perf_counter()
+            result_img = cv2.cvtColor(result_img, cv2.COLOR_RGB2BGR)
+            times['color'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        encoded_bytes = cv2.imencode(encode_format, result_img, params)[1].size
+        times['encode'] = time.perf_counter() - start
+
+        for stage, seconds in times.items():
+            timings[stage].append(seconds)
+        timings['total'].append(sum(times.values()))
+    return timings, encoded_bytes
+
+
+def case_key(case):
+    key = "%dx%d/b%d/denoise=%s/threads=%dx%d" % (case['width'], case['height'], case['batch_size'],
+                                                  case['denoise'], case['intra_op_threads'],
+                                                  case['inter_op_threads'])
+    if case.get('encode'):  # left out for the defaults, so reports from before encode presets still compare
+        key += "/encode=%s" % case['encode']
+    if case.get('backend', 'tensorflow') != 'tensorflow':
+        key += "/backend=%s" % case['backend']
+    return key
+
+
+def run_benchmark(resolutions, batch_sizes, denoise_modes, threads, model=None, repeat=5, warmup=1, gpu=False,
+                  denoise_preset='standard', encode_presets=(None,), encode_format='.png', backends=('tensorflow',),
+                  log=print):
+    """
+    Time every combination of the given settings.
+    :param resolutions: [(width, height), ...]
+    :param threads: [(intra_op_threads, inter_op_threads), ...]
+    :param model: frozen .pb to benchmark, a synthetic one is generated when None.
+    :param denoise_preset: preset from denoise.PRESETS used by the denoise modes.
+    :param encode_presets: [name from encoding.PRESETS or None for OpenCV's defaults, ...]
+    :param encode_format: extension of the format results are encoded to.
+    :param backends: [name from backends.BACKENDS, ...], each one's peak memory is measured in its own process
+        at the largest resolution.
+    :return:
+        a JSON serializable report, see compare.
+    """
+    from enhancer import Enhancer
+
+    with tempfile.TemporaryDirectory() as tmp:
+        model_path = model or make_synthetic_model(os.path.join(tmp, 'synthetic.pb'))
+        results = []
+        for backend, (intra, inter) in itertools.product(backends, threads):
+            enhancer = Enhancer(gpu=gpu, intra_op_threads=intra, inter_op_threads=inter, backend=backend)
+            start = time.perf_counter()
+            try:
+                enhancer.load_model(model_path)
+            except Exception as e:  # an optional backend that isn't installed or can't import the model
+                log("skipping backend %s: %s" % (backend, e))
+                continue
+            load_seconds = time.perf_counter() - start
+            peak_megabytes = peak_memory(model_path, backend, gpu, intra, inter,
+                                         max(resolutions, key=lambda size: size[0] * size[1]))
+            log("%s %dx%d: loaded in %.2fs, peak memory %s MB" % (backend, intra, inter, load_seconds,
+                                                                 '?' if peak_megabytes is None else
+                                                                 '%.0f' % peak_megabytes))
+
+            for (width, height), batch_size, denoise, encode in itertools.product(resolutions, batch_sizes,
+                                                                                  denoise_modes, encode_presets):
+                case = {'width': width, 'height': height, 'batch_size': batch_size,
+                        'denoise': denoise if denoise == 'none' else '%s:%s' % (denoise, denoise_preset),
+                        'intra_op_threads': intra, 'inter_op_threads': inter, 'backend': backend,
+                        'encode': encode and '%s:%s' % (encode_format.lstrip('.'), encode)}
+                if warmup:
+                    run_case(enhancer, width, height, batch_size, denoise, warmup, denoise_preset, encode,
+                             encode_format)
+                timings, encoded_bytes = run_case(enhancer, width, height, batch_size, denoise, repeat,
+                                                  denoise_preset, encode, encode_format)
+                total = statistics.median(timings['total'])
+                encode_seconds = max(statistics.median(timings['encode']), 1e-9)
+                case.update({
+                    'key': case_key(case),
+                    'load_seconds': load_seconds,
+                    'peak_megabytes': peak_megabytes,
+                    'stages': {stage: _summary(samples) for stage, samples in timings.items()},
+                    'images_per_second': 1 / total,
+                    'megapixels_per_second': width * height / 1e6 / total,
+                    'encoded_bytes': encoded_bytes,
+                    'encode_megapixels_per_second': width * height / 1e6 / encode_seconds,
+                })
+                results.append(case)
+                log("%-60s %8.1f ms/image  %6.2f MP/s  encode %6.2f MP/s %8.1f KB"
+                    % (case['key'], total * 1e3, case['megapixels_per_second'],
+                       case['encode_megapixels_per_second'], encoded_bytes / 1e3))
+            enhancer.close()
+
+    return {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'opencv': cv2.__version__,
+            'numpy': np.__version__,
+            'model': os.path.basename(model) if model else 'synthetic',
+            'repeat': repeat,
+        },
+        'results': results,
+    }
+
+
+def save(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(baseline, current, threshold=0.1, log=print):
+    """
+    Compare the median total time of the cases present in both reports.
+    :param threshold: relative slowdown reported as a regression.
+    :return:
+        number of regressions.
+    """
+    old = {case['key']: case for case in baseline['results']}
+    regressions = 0
+    for case in current['results']:
+        if case['key'] not in old:
+            continue
+        before = old[case['key']]['stages']['total']['median']
+        after = case['stages']['total']['median']
+        change = after / before - 1
+        slower = change > threshold
+        regressions += slower
+        log("%-45s %8.1f -> %8.1f ms  %+6.1f%%%s" % (case['key'], before * 1e3, after * 1e3, change * 100,
+                                                   '  REGRESSION' if slower else ''))
+    return regressions
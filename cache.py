@@ -0,0 +1,150 @@
+import hashlib
+import json
+import logging
+import os
+import threading as td
+from collections import OrderedDict
+
+import numpy as np
+
+
+def default_cache_dir():
+    return os.path.join(os.path.expanduser('~'), '.cache', 'fantastic-filter')
+
+
+class ResultCache:
+    """
+    Enhanced images keyed by input pixels, model and parameters.
+    Recent results stay in memory, all of them go to an optional directory; both are LRU bounded by size.
+    """
+
+    def __init__(self, directory=None, max_memory_bytes=512 << 20, max_disk_bytes=4 << 30):
+        """
+        :param directory: where results are stored across runs, None keeps them in memory only.
+        """
+        self.directory = directory
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        self._lock = td.Lock()
+        if directory:
+            self._load_index()
+
+    @staticmethod
+    def key(image, model_hash, **params):
+        sha1 = hashlib.sha1()
+        sha1.update(('%s:%s:%s:' % (image.shape, image.dtype, model_hash)).encode())
+        sha1.update(json.dumps(params, sort_keys=True).encode())
+        sha1.update(np.ascontiguousarray(image).data)
+        return sha1.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.npy')
+
+    def _load_index(self):
+        entries = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith('.npy') and not name.endswith('.tmp.npy'):
+                    stat = os.stat(os.path.join(root, name))
+                    entries.append((stat.st_mtime, name[:-4], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+
+    def get(self, key):
+        """
+        :return:
+            the cached read-only result, or None.
+        """
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return self._memory[key]
+            on_disk = key in self._disk
+
+        if on_disk:
+            try:
+                image = np.load(self._path(key))
+                os.utime(self._path(key))
+            except (OSError, ValueError) as e:
+                logging.warning("drop broken cache entry %s: %s", key, e)
+                self._forget(key)
+            else:
+                image.flags.writeable = False
+                with self._lock:
+                    self._disk.move_to_end(key)
+                    self.hits += 1
+                    self._remember(key, image)
+                return image
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, image):
+        image = np.array(image)
+        image.flags.writeable = False
+        with self._lock:
+            self._remember(key, image)
+        if self.directory:
+            path = self._path(key)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # processes and the pipeline's threads may store the same key at once
+                temp_path = '%s.%d.%d.tmp.npy' % (path, os.getpid(), td.get_ident())
+                np.save(temp_path, image)
+                os.replace(temp_path, path)
+            except OSError as e:
+                logging.warning("can't write cache entry %s: %s", key, e)
+                return
+            with self._lock:
+                if key not in self._disk:
+                    self._disk[key] = os.path.getsize(path)
+                    self._disk_bytes += self._disk[key]
+                self._evict_disk()
+
+    def _remember(self, key, image):
+        if image.nbytes > self.max_memory_bytes:
+            return
+        if key not in self._memory:
+            self._memory_bytes += image.nbytes
+        self._memory[key] = image
+        self._memory.move_to_end(key)
+        while self._memory_bytes > self.max_memory_bytes:
+            _, old = self._memory.popitem(last=False)
+            self._memory_bytes -= old.nbytes
+
+    def _evict_disk(self):
+        while self._disk_bytes > self.max_disk_bytes and len(self._disk) > 1:
+            key, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def _forget(self, key):
+        with self._lock:
+            size = self._disk.pop(key, None)
+            if size is not None:
+                self._disk_bytes -= size
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+            keys = list(self._disk)
+            self._disk.clear()
+            self._disk_bytes = 0
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
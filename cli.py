@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+from paths import find_images, output_path
+
+DENOISE_PRESETS = ('fine', 'standard', 'fast', 'faster', 'fastest')
+BACKEND_CHOICES = ('auto', 'tensorflow', 'opencv', 'onnxruntime', 'tflite')
+TILE_OVERLAP, TILE_MARGIN = 32, 8  # Enhancer's defaults, repeated so parsing arguments doesn't import it
+
+
+def model_path(name):
+    if os.path.isfile(name):
+        return name
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pretrained', name + '.pb')
+    if os.path.isfile(path):
+        return path
+    raise argparse.ArgumentTypeError("model '%s' not found" % name)
+
+
+def add_model_arguments(parser):
+    parser.add_argument('-m', '--model', type=model_path, required=True,
+                        help="path to a frozen .pb model, or the name of one in pretrained/")
+    parser.add_argument('--cpu', action='store_true', help="don't use the GPU")
+    parser.add_argument('--tile-size', type=int, default=None,
+                        help="enhance images larger than this in overlapping tiles")
+    parser.add_argument('--tile-overlap', type=int, default=TILE_OVERLAP,
+                        help="pixels shared by neighbouring tiles, feathered together to hide the seams")
+    parser.add_argument('--tile-margin', type=int, default=TILE_MARGIN,
+                        help="pixels at inner tile edges thrown away, at least the model's receptive field radius "
+                             "and less than half the overlap")
+    parser.add_argument('--cache-dir', default=None,
+                        help="reuse results of identical images, model and options stored in this directory")
+    parser.add_argument('--trace-dir', default=None,
+                        help="write a Chrome trace of every session call into this directory")
+    parser.add_argument('--buckets', type=bucket, nargs='+', default=None, metavar='N|WxH',
+                        help="pad inputs to a multiple of N, or to the smallest WIDTHxHEIGHT that fits, "
+                             "so the session sees fewer distinct shapes")
+    parser.add_argument('--warmup', action='store_true', help="run every WIDTHxHEIGHT bucket once after loading, needs --buckets as shapes")
+    parser.add_argument('--backend', choices=BACKEND_CHOICES, default='auto',
+                        help="what runs the model, auto picks per model (see backends.py)")
+
+
+def add_enhance_arguments(parser):
+    parser.add_argument('--denoise', action='store_true', help="denoise before enhancing")
+    parser.add_argument('--denoise-after', action='store_true', help="denoise after enhancing")
+    parser.add_argument('--denoise-preset', choices=DENOISE_PRESETS, default='standard',
+                        help="speed versus quality of --denoise and --denoise-after")
+    parser.add_argument('--width', type=int, default=None, help="resize to this width before enhancing")
+    parser.add_argument('--height', type=int, default=None, help="resize to this height before enhancing")
+
+
+def add_pipeline_arguments(parser):
+    parser.add_argument('-j', '--workers', type=int, default=1, help="threads feeding the model")
+    parser.add_argument('--readers', type=int, default=2, help="threads decoding input images")
+    parser.add_argument('--writers', type=int, default=2, help="threads encoding and saving results")
+    parser.add_argument('--queue-depth', type=int, default=4,
+                        help="images allowed to wait between pipeline stages, bounds memory usage")
+    parser.add_argument('-b', '--batch-size', type=int, default=1,
+                        help="most images of the same size enhanced in one session call")
+    parser.add_argument('--encode-preset', choices=('fast', 'balanced', 'small'), default=None,
+                        help="PNG compression, JPEG and WebP settings trading encoding speed for file size, "
+                             "OpenCV's defaults when omitted")
+
+
+def parse_buckets(args):
+    buckets = args.buckets
+    if buckets and isinstance(buckets[0], int):
+        if len(buckets) > 1:
+            raise SystemExit("--buckets takes a single multiple or a list of WIDTHxHEIGHT")
+        buckets = buckets[0]
+    if getattr(args, 'warmup', None) is True and (not buckets or isinstance(buckets, int)):
+        raise SystemExit("--warmup needs --buckets as WIDTHxHEIGHT shapes, a multiple doesn't say which sizes to run")
+    return buckets
+
+
+def create_enhancer(args):
+    from cache import ResultCache
+    from enhancer import Enhancer
+
+    enhancer = Enhancer(gpu=not args.cpu, tile_size=args.tile_size, tile_overlap=args.tile_overlap,
+                        tile_margin=args.tile_margin, trace_dir=args.trace_dir,
+                        cache=ResultCache(args.cache_dir) if args.cache_dir else None, buckets=parse_buckets(args),
+                        encode_preset=getattr(args, 'encode_preset', None), backend=args.backend)
+    enhancer.load_model(args.model, warmup=args.warmup)
+    return enhancer
+
+
+def report(results, seconds):
+    done = [result for result in results if result['success']]
+    failed = len(results) - len(done)
+    megapixels = sum(result['pixels'] for result in done) / 1e6
+    seconds = max(seconds, 1e-9)
+    print("%d images (%d failed) in %.2fs: %.2f images/s, %.2f MP/s"
+          % (len(done), failed, seconds, len(done) / seconds, megapixels / seconds))
+    encoded = [result for result in done if 'bytes' in result]
+    encode_seconds = sum(result['stages'].get('encode', 0.) for result in encoded)
+    if encode_seconds:
+        megabytes = sum(result['bytes'] for result in encoded) / 1e6
+        print("encoder: %.2f MP/s, %.2f MB/s, %.1f MB written"
+              % (sum(result['pixels'] for result in encoded) / 1e6 / encode_seconds, megabytes / encode_seconds,
+                 megabytes))
+
+
+def batch_command(args):
+    files = find_images(args.inputs)
+    if not files:
+        logging.error("no images found.")
+        return 1
+    os.makedirs(args.output, exist_ok=True)
+
+    large = []
+    if args.stream_above:
+        from largeimage import image_size
+
+        for path in files:
+            width, height = image_size(path)
+            if width * height > args.stream_above * 1e6:
+                large.append(path)
+        files = [path for path in files if path not in large]
+        if large and (args.denoise or args.denoise_after or args.width or args.height):
+            logging.warning("denoise and resize options don't apply to the %d streamed images", len(large))
+
+    jobs = [{
+        'path': path,
+        'save_path': output_path(path, args.output, args.format),
+        'denoise': args.denoise and args.denoise_preset,
+        'denoise_after': args.denoise_after and args.denoise_preset,
+        'resize': (args.width, args.height),
+    } for path in files]
+
+    start = time.perf_counter()
+    enhancer = None
+    if args.processes:
+        from shard import ProcessPool
+
+        pool = ProcessPool(args.model, args.processes, args.cores_per_process, gpu=not args.cpu,
+                           tile_size=args.tile_size, tile_overlap=args.tile_overlap, tile_margin=args.tile_margin,
+                           buckets=parse_buckets(args), cache_dir=args.cache_dir,
+                           warmup=args.warmup, encode_preset=args.encode_preset, backend=args.backend)
+        results = pool.map_files(jobs)
+        pool.close()
+        metrics = pool.metrics
+    else:
+        enhancer = create_enhancer(args)
+        for job in jobs:
+            enhancer.add_files(job)
+        results = enhancer.batch_process(workers=args.workers, readers=args.readers, writers=args.writers,
+                                         queue_depth=args.queue_depth, batch_size=args.batch_size,
+                                         max_batch_pixels=int(args.max_batch_mp * 1e6) if args.max_batch_mp else None)
+        metrics = enhancer.metrics
+    if large:
+        from largeimage import enhance_large
+
+        if enhancer is None:
+            enhancer = create_enhancer(args)
+            enhancer.metrics = metrics
+        for path in large:
+            save_path = output_path(path, args.output, args.stream_format)
+            results.append(enhance_large(enhancer, path, save_path, scratch_dir=args.scratch_dir))
+    report(results, time.perf_counter() - start)
+    if args.metrics:
+        print(metrics.format())
+    if enhancer is not None:
+        enhancer.close()
+    return 0 if all(result['success'] for result in results) else 2
+
+
+def watch_command(args):
+    from watch import FolderWatcher, Manifest
+
+    enhancer = create_enhancer(args)
+    manifest = Manifest(args.manifest or os.path.join(args.output, '.manifest.json'))
+    options = {'denoise': args.denoise and args.denoise_preset,
+               'denoise_after': args.denoise_after and args.denoise_preset,
+               'resize': (args.width, args.height)}
+    watcher = FolderWatcher(enhancer, args.inputs, args.output, manifest, options, extension=args.format,
+                            interval=args.interval, workers=args.workers, readers=args.readers,
+                            writers=args.writers, queue_depth=args.queue_depth, batch_size=args.batch_size)
+    try:
+        if args.once:
+            os.makedirs(args.output, exist_ok=True)
+            start = time.perf_counter()
+            report(watcher.run_once(), time.perf_counter() - start)
+        else:
+            logging.info("watching %s, %d files in manifest", ', '.join(args.inputs), len(manifest))
+            watcher.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        enhancer.close()
+    return 0
+
+
+def video_command(args):
+    from video import enhance_video
+
+    enhancer = create_enhancer(args)
+    stats = enhance_video(enhancer, args.input, args.output, denoise=args.denoise and args.denoise_preset,
+                          denoise_after=args.denoise_after and args.denoise_preset,
+                          resize=(args.width, args.height), fps=args.fps, fourcc=args.fourcc,
+                          temporal_window=args.temporal_window, queue_depth=args.queue_depth,
+                          batch_size=args.batch_size)
+    seconds = max(stats['seconds'], 1e-9)
+    print("%d frames in %.2fs: %.2f frames/s, %.2f MP/s"
+          % (stats['frames'], seconds, stats['frames'] / seconds, stats['pixels'] / 1e6 / seconds))
+    enhancer.close()
+    return 0
+
+
+def serve_command(args):
+    from server import InferenceServer
+
+    enhancer = create_enhancer(args)
+    enhancer.scheduler_workers = args.workers
+    enhancer.max_batch = args.batch_size
+    server = InferenceServer(enhancer, args.address, max_queue=args.max_queue)
+    print("serving on %s" % args.address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        enhancer.close()
+    return 0
+
+
+def client_command(args):
+    from concurrent.futures import ThreadPoolExecutor
+
+    from server import Client
+
+    client = Client(args.server)
+    if args.health or not args.inputs:
+        try:
+            print(json.dumps(client.health(), indent=2))
+        except OSError as e:
+            logging.error("server at %s unavailable: %s", args.server, e)
+            return 1
+        return 0
+
+    files = find_images(args.inputs)
+    if not files:
+        logging.error("no images found.")
+        return 1
+    os.makedirs(args.output, exist_ok=True)
+
+    def enhance(path):
+        try:
+            pixels = client.enhance_file(path, output_path(path, args.output, args.format),
+                                         denoise=args.denoise and args.denoise_preset,
+                                         denoise_after=args.denoise_after and args.denoise_preset,
+                                         width=args.width, height=args.height)
+            return {'path': path, 'success': True, 'pixels': pixels, 'error': ''}
+        except OSError as e:
+            logging.error("'%s' failed: %s", path, e)
+            return {'path': path, 'success': False, 'pixels': 0, 'error': str(e)}
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        results = list(executor.map(enhance, files))
+    report(results, time.perf_counter() - start)
+    return 0 if all(result['success'] for result in results) else 2
+
+
+def size(value):
+    try:
+        width, height = value.lower().split('x')
+        return int(width), int(height)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected WIDTHxHEIGHT, got '%s'" % value)
+
+
+def bucket(value):
+    return int(value) if value.isdigit() else size(value)
+
+
+def threads(value):
+    try:
+        intra, inter = value.split('x')
+        return int(intra), int(inter)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected INTRAxINTER, got '%s'" % value)
+
+
+def bench_command(args):
+    import benchmark
+
+    report = benchmark.run_benchmark(args.resolutions, args.batch_sizes, args.denoise, args.threads,
+                                     model=args.model, repeat=args.repeat, warmup=args.warmup, gpu=args.gpu,
+                                     backends=args.backends,
+                                     denoise_preset=args.denoise_preset,
+                                     encode_presets=[None if preset == 'default' else preset
+                                                     for preset in args.encode_presets],
+                                     encode_format='.' + args.encode_format)
+    if args.output:
+        benchmark.save(report, args.output)
+    if args.compare:
+        regressions = benchmark.compare(benchmark.load(args.compare), report, threshold=args.threshold)
+        if regressions:
+            print("%d regressions." % regressions)
+            return 3
+    return 0
+
+
+def optimize_command(args):
+    import optimizer
+
+    target = args.output or os.path.splitext(args.model)[0] + '-optimized.pb'
+    stats = optimizer.optimize_model(args.model, target, weights=args.weights,
+                                     fold_preprocessing=not args.keep_preprocessing)
+    print("%s: %d -> %d nodes, %.2f -> %.2f MB"
+          % (target, stats['source_nodes'], stats['target_nodes'],
+             stats['source_bytes'] / 1e6, stats['target_bytes'] / 1e6))
+    if all(args.compare_size):
+        width, height = args.compare_size
+        result = optimizer.compare_models(args.model, target, width, height, repeat=args.repeat, gpu=not args.cpu)
+        for name in ('source', 'target'):
+            print("%-7s load %7.1f ms  run %7.1f ms"
+                  % (name, result[name]['load_seconds'] * 1e3, result[name]['run_seconds'] * 1e3))
+        print("largest pixel difference: %d" % result['max_difference'])
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Fantastic Filter command line tools.")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    batch = commands.add_parser('batch', help="enhance image files")
+    batch.add_argument('inputs', nargs='+', help="image files, directories or glob patterns")
+    batch.add_argument('-o', '--output', required=True, help="directory the results are written to")
+    batch.add_argument('--format', default=None, help="output file extension, defaults to the input's")
+    add_pipeline_arguments(batch)
+    batch.add_argument('--max-batch-mp', type=float, default=None,
+                       help="memory budget of one session call in megapixels")
+    batch.add_argument('--metrics', action='store_true', help="print time spent in every stage")
+    batch.add_argument('--stream-above', type=float, default=None, metavar='MP',
+                       help="images larger than this many megapixels are read, enhanced and written in strips")
+    batch.add_argument('--stream-format', choices=('png', 'tif', 'npy'), default='png',
+                       help="output format of streamed images, tif needs tifffile")
+    batch.add_argument('--scratch-dir', default=None, help="where streamed images are decoded to")
+    batch.add_argument('-p', '--processes', type=int, default=None,
+                       help="split the images between this many worker processes, each pinned to its own cores")
+    batch.add_argument('--cores-per-process', type=int, default=None,
+                       help="cores given to each worker process, the available cores are split evenly by default")
+    add_model_arguments(batch)
+    add_enhance_arguments(batch)
+    batch.set_defaults(func=batch_command)
+
+    watch = commands.add_parser('watch', help="keep the model loaded and enhance new or changed images")
+    watch.add_argument('inputs', nargs='+', help="directories or glob patterns to watch")
+    watch.add_argument('-o', '--output', required=True, help="directory the results are written to")
+    watch.add_argument('--format', default=None, help="output file extension, defaults to the input's")
+    watch.add_argument('--manifest', default=None,
+                       help="record of processed files, defaults to .manifest.json in the output directory")
+    watch.add_argument('--interval', type=float, default=5., help="seconds between scans")
+    watch.add_argument('--once', action='store_true', help="process what's pending and exit")
+    add_pipeline_arguments(watch)
+    add_model_arguments(watch)
+    add_enhance_arguments(watch)
+    watch.set_defaults(func=watch_command)
+
+    video = commands.add_parser('video', help="enhance a video or a numbered frame sequence")
+    video.add_argument('input', help="video file or frame pattern such as 'frames/%%05d.png'")
+    video.add_argument('output', help="video file or frame pattern such as 'out/%%05d.png'")
+    video.add_argument('--fps', type=float, default=None, help="output frame rate, defaults to the input's")
+    video.add_argument('--fourcc', default='mp4v', help="output codec")
+    video.add_argument('--temporal-window', type=int, default=5,
+                       help="odd number of neighbouring frames denoised together")
+    video.add_argument('--queue-depth', type=int, default=8, help="frames in flight between stages")
+    video.add_argument('-b', '--batch-size', type=int, default=1, help="frames enhanced in one session call")
+    add_model_arguments(video)
+    add_enhance_arguments(video)
+    video.set_defaults(func=video_command)
+
+    bench = commands.add_parser('bench', help="time Enhancer stages, with a synthetic model by default")
+    bench.add_argument('-m', '--model', default=None, help="frozen .pb to benchmark instead of the synthetic model")
+    bench.add_argument('-r', '--resolutions', type=size, nargs='+', default=[(512, 512), (1024, 1024)],
+                       metavar='WxH')
+    bench.add_argument('-b', '--batch-sizes', type=int, nargs='+', default=[1, 4])
+    bench.add_argument('-d', '--denoise', nargs='+', choices=('none', 'before', 'after', 'both'), default=['none'])
+    bench.add_argument('-t', '--threads', type=threads, nargs='+', default=[(0, 0)], metavar='INTRAxINTER',
+                       help="session thread settings, 0 lets TensorFlow decide")
+    bench.add_argument('--denoise-preset', choices=DENOISE_PRESETS, default='standard')
+    bench.add_argument('-e', '--encode-presets', nargs='+', choices=('default', 'fast', 'balanced', 'small'),
+                       default=['default'], help="encoder settings to compare, default is OpenCV's")
+    bench.add_argument('--encode-format', choices=('png', 'jpg', 'webp'), default='png')
+    bench.add_argument('--backends', nargs='+', choices=BACKEND_CHOICES[1:], default=['tensorflow'],
+                       help="backends to compare, also reports their load time and peak memory")
+    bench.add_argument('--repeat', type=int, default=5)
+    bench.add_argument('--warmup', type=int, default=1)
+    bench.add_argument('--gpu', action='store_true')
+    bench.add_argument('-o', '--output', default=None, help="write the results as JSON")
+    bench.add_argument('--compare', default=None, help="JSON results of an earlier run to compare against")
+    bench.add_argument('--threshold', type=float, default=0.1, help="relative slowdown counted as a regression")
+    bench.set_defaults(func=bench_command)
+
+    serve = commands.add_parser('serve', help="keep a model loaded and enhance images sent by local clients")
+    serve.add_argument('--address', default='127.0.0.1:8765', help="HOST:PORT, or the path of a Unix socket")
+    serve.add_argument('--max-queue', type=int, default=64, help="waiting requests before clients get 503")
+    serve.add_argument('-j', '--workers', type=int, default=1, help="threads feeding the model")
+    serve.add_argument('-b', '--batch-size', type=int, default=4,
+                       help="most waiting images of the same size enhanced in one session call")
+    add_model_arguments(serve)
+    serve.set_defaults(func=serve_command)
+
+    client = commands.add_parser('client', help="enhance image files with a running 'serve'")
+    client.add_argument('inputs', nargs='*', help="image files, directories or glob patterns")
+    client.add_argument('-o', '--output', default='.', help="directory the results are written to")
+    client.add_argument('--format', default=None, help="output file extension, defaults to the input's")
+    client.add_argument('--server', default='127.0.0.1:8765', help="address given to 'serve'")
+    client.add_argument('-j', '--jobs', type=int, default=4, help="requests sent at the same time")
+    client.add_argument('--health', action='store_true', help="print the server status and exit")
+    add_enhance_arguments(client)
+    client.set_defaults(func=client_command)
+
+    optimize = commands.add_parser('optimize', help="fold, strip and shrink a frozen model")
+    optimize.add_argument('-m', '--model', type=model_path, required=True,
+                          help="path to a frozen .pb model, or the name of one in pretrained/")
+    optimize.add_argument('-o', '--output', default=None, help="defaults to <model>-optimized.pb")
+    optimize.add_argument('--weights', choices=('float32', 'float16', 'int8'), default='float32',
+                          help="storage type of the weights, float16 and int8 trade accuracy for size")
+    optimize.add_argument('--keep-preprocessing', action='store_true',
+                          help="keep the float -1 ~ +1 input instead of folding the normalization in")
+    optimize.add_argument('--compare-size', type=size, default=(512, 512), metavar='WxH',
+                          help="time both models on an image of this size, 0x0 to skip")
+    optimize.add_argument('--repeat', type=int, default=3)
+    optimize.add_argument('--cpu', action='store_true', help="don't use the GPU for the comparison")
+    optimize.set_defaults(func=optimize_command)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,99 @@
+import os
+import threading as td
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+
+DENOISE_TILE = 512
+
+
+def _nlmeans(image, h, h_color, template_size, search_size):
+    return cv2.fastNlMeansDenoisingColored(image, None, h, h_color, template_size, search_size)
+
+
+def _bilateral(image, diameter, sigma_color, sigma_space):
+    return cv2.bilateralFilter(image, diameter, sigma_color, sigma_space)
+
+
+def _median(image, ksize):
+    return cv2.medianBlur(image, ksize)
+
+
+def _gaussian(image, ksize, sigma):
+    return cv2.GaussianBlur(image, (ksize, ksize), sigma)
+
+
+# algorithm: (function, pixels around a tile it needs to reproduce the untiled result)
+ALGORITHMS = {
+    'nlmeans': (_nlmeans, lambda p: p['template_size'] // 2 + p['search_size'] // 2),
+    'bilateral': (_bilateral, lambda p: p['diameter'] // 2 + 1),
+    'median': (_median, lambda p: p['ksize'] // 2),
+    'gaussian': (_gaussian, lambda p: p['ksize'] // 2),
+}
+
+PRESETS = {
+    # the parameters sample() used for denoise before enhancing
+    'fine': ('nlmeans', {'h': 5, 'h_color': 5, 'template_size': 7, 'search_size': 21}),
+    # the parameters batch_process() and denoise after enhancing used
+    'standard': ('nlmeans', {'h': 10, 'h_color': 10, 'template_size': 5, 'search_size': 5}),
+    'fast': ('bilateral', {'diameter': 7, 'sigma_color': 35, 'sigma_space': 7}),
+    'faster': ('median', {'ksize': 3}),
+    'fastest': ('gaussian', {'ksize': 3, 'sigma': 0.8}),
+}
+
+_executor = None
+_executor_lock = td.Lock()
+
+
+def _default_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix='denoise')
+        return _executor
+
+
+def resolve_preset(value, default):
+    """
+    :param value: False/None for no denoise, True for the default preset, or a preset name.
+    :return:
+        preset name or None.
+    """
+    if not value:
+        return None
+    preset = default if value is True else value
+    if preset not in PRESETS:
+        raise ValueError("unknown denoise preset '%s', expected one of %s" % (preset, ', '.join(PRESETS)))
+    return preset
+
+
+def denoise_image(image, preset='standard', tile_size=DENOISE_TILE, executor=None):
+    """
+    Denoise image with a named preset. Large images are split into tiles with enough margin
+    for the filter's window, so the result matches the untiled one, and run on a thread pool.
+    :param executor: pool the tiles run on, a shared one sized to the core count by default.
+    """
+    algorithm, params = PRESETS[preset]
+    fn, margin = ALGORITHMS[algorithm]
+    margin = margin(params)
+    h, w = image.shape[:2]
+    if not tile_size or max(h, w) <= tile_size:
+        return fn(image, **params)
+
+    def run(box):
+        y0, y1, x0, x1 = box
+        top, left = max(0, y0 - margin), max(0, x0 - margin)
+        tile = fn(np.ascontiguousarray(image[top:min(h, y1 + margin), left:min(w, x1 + margin)]), **params)
+        return box, tile[y0 - top:y1 - top, x0 - left:x1 - left]
+
+    boxes = [(y0, y1, x0, x1) for y0, y1 in _spans(h, tile_size) for x0, x1 in _spans(w, tile_size)]
+    result = np.empty_like(image)
+    for (y0, y1, x0, x1), tile in (executor or _default_executor()).map(run, boxes):
+        result[y0:y1, x0:x1] = tile
+    return result
+
+
+def _spans(length, tile_size):
+    return [(start, min(start + tile_size, length)) for start in range(0, length, tile_size)]
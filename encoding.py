@@ -0,0 +1,153 @@
+import logging
+import os
+import threading as td
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# speed versus size trade-offs of the lossless and lossy encoders, see cv2_params
+PRESETS = {
+    'fast': {'png_level': 1, 'png_rle': True, 'webp_quality': 80,
+             'jpeg_quality': 90, 'jpeg_optimize': False, 'jpeg_progressive': False},
+    'balanced': {'png_level': 6, 'png_rle': False, 'webp_quality': 90,
+                 'jpeg_quality': 92, 'jpeg_optimize': True, 'jpeg_progressive': False},
+    'small': {'png_level': 9, 'png_rle': False, 'webp_quality': 75,
+              'jpeg_quality': 85, 'jpeg_optimize': True, 'jpeg_progressive': True},
+}
+FORMATS = {'.png': 'png', '.jpg': 'jpeg', '.jpeg': 'jpeg', '.webp': 'webp'}
+
+
+def image_format(path):
+    """
+    :return:
+        'png', 'jpeg', 'webp' or None for formats without presets.
+    """
+    extension = os.path.splitext(path)[1] or path
+    return FORMATS.get('.' + extension.lower().lstrip('.'))
+
+
+def _preset(preset):
+    if preset not in PRESETS:
+        raise ValueError("unknown encode preset '%s', expected one of %s" % (preset, ', '.join(PRESETS)))
+    return PRESETS[preset]
+
+
+def cv2_params(path, preset=None):
+    """
+    :param path: file path or extension.
+    :param preset: name from PRESETS, None keeps OpenCV's defaults.
+    :return:
+        params for cv2.imencode / cv2.imwrite. OpenCV has no WebP speed setting, a lower quality is both faster and smaller.
+    """
+    import cv2
+
+    kind = image_format(path)
+    if preset is None or kind is None:
+        return []
+    options = _preset(preset)
+    if kind == 'png':
+        params = [cv2.IMWRITE_PNG_COMPRESSION, options['png_level'], cv2.IMWRITE_PNG_STRATEGY,
+                  cv2.IMWRITE_PNG_STRATEGY_RLE if options['png_rle'] else cv2.IMWRITE_PNG_STRATEGY_DEFAULT]
+        if hasattr(cv2, 'IMWRITE_PNG_FILTER'):  # OpenCV 4.11 and later, the Sub filter is what it uses by default
+            params += [cv2.IMWRITE_PNG_FILTER, cv2.IMWRITE_PNG_FILTER_SUB]
+        return params
+    if kind == 'jpeg':
+        return [cv2.IMWRITE_JPEG_QUALITY, options['jpeg_quality'],
+                cv2.IMWRITE_JPEG_OPTIMIZE, int(options['jpeg_optimize']),
+                cv2.IMWRITE_JPEG_PROGRESSIVE, int(options['jpeg_progressive'])]
+    return [cv2.IMWRITE_WEBP_QUALITY, options['webp_quality']]
+
+
+class EncoderPool:
+    """
+    Encodes and writes images on background threads, so a slow PNG never holds up the caller.
+    OpenCV releases the GIL while compressing, several files encode in parallel.
+    """
+
+    def __init__(self, workers=2, metrics=None):
+        """
+        :param metrics: Metrics the 'encode' stage of every file is recorded in.
+        """
+        self.metrics = metrics
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='encoder')
+        self._lock = td.Lock()
+        self._submitted = 0
+        self._done = 0
+        self._images = 0
+        self._pixels = 0
+        self._bytes = 0
+        self._seconds = 0.
+
+    def save(self, image, path, preset=None):
+        """
+        :param image: PIL image, RGB array, or a callable returning either, called on the encoder thread.
+        :param preset: name from PRESETS, None keeps OpenCV's defaults.
+        :return:
+            Future of {'path': str, 'pixels': int, 'bytes': int, 'seconds': float}.
+        """
+        with self._lock:
+            self._submitted += 1
+        return self._executor.submit(self._save, image, path, preset)
+
+    def _save(self, image, path, preset):
+        import cv2
+
+        try:
+            if callable(image):
+                image = image()
+            if hasattr(image, 'getbands'):  # PIL, palette, CMYK and 16 bit modes don't map to BGR(A) bytes
+                image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+            image = np.asarray(image)
+            if image.ndim == 3 and image.shape[2] == 4 and image_format(path) != 'jpeg':
+                image = cv2.cvtColor(image, cv2.COLOR_RGBA2BGRA)
+            elif image.ndim == 3:
+                image = cv2.cvtColor(image[:, :, :3], cv2.COLOR_RGB2BGR)
+
+            start = time.perf_counter()
+            extension = os.path.splitext(path)[1] or '.png'
+            ok, data = cv2.imencode(extension, image, cv2_params(extension, preset))
+            if not ok:
+                raise IOError("can't encode image '%s'" % path)
+            temp_path = path + '.tmp' + extension
+            with open(temp_path, 'wb') as f:
+                f.write(data.tobytes())
+            os.replace(temp_path, path)
+            seconds = time.perf_counter() - start
+            if self.metrics is not None:
+                self.metrics.record('encode', seconds)
+            record = {'path': path, 'pixels': image.shape[0] * image.shape[1], 'bytes': data.size,
+                      'seconds': seconds}
+            with self._lock:
+                self._images += 1
+                self._pixels += record['pixels']
+                self._bytes += record['bytes']
+                self._seconds += seconds
+            logging.info("saved '%s', %d bytes in %.2fs", path, record['bytes'], seconds)
+            return record
+        finally:
+            with self._lock:
+                self._done += 1
+
+    def progress(self):
+        """
+        :return:
+            (files finished, files submitted)
+        """
+        with self._lock:
+            return self._done, self._submitted
+
+    def throughput(self):
+        """
+        :return:
+            {'images': int, 'megapixels': float, 'megabytes': float, 'seconds': float,
+             'megapixels_per_second': float, 'megabytes_per_second': float} of the files encoded so far.
+        """
+        with self._lock:
+            seconds = max(self._seconds, 1e-9)
+            return {'images': self._images, 'megapixels': self._pixels / 1e6, 'megabytes': self._bytes / 1e6,
+                    'seconds': self._seconds, 'megapixels_per_second': self._pixels / 1e6 / seconds,
+                    'megabytes_per_second': self._bytes / 1e6 / seconds}
+
+    def close(self, wait=True):
+        self._executor.shutdown(wait=wait)
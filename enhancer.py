@@ -1,73 +1,145 @@
 import logging
 import os
+import threading as td
+import time
 
 import cv2
 import numpy as np
-import tensorflow as tf
+
+from backends import load_backend
+from denoise import denoise_image, resolve_preset
+from encoding import cv2_params
+from metrics import Metrics
+from pipeline import Failure, Pipeline, Stage
+from registry import ModelRegistry
+from scheduler import PRIORITY_NORMAL, Request, Scheduler
+from tiling import blend_tiles
+
+TILE_OVERLAP = 32
+TILE_MARGIN = 8
+TILE_MULTIPLE = 8
 
 
 class Enhancer:
-    def __init__(self, gpu=True):
+    def __init__(self, gpu=True, tile_size=None, tile_overlap=TILE_OVERLAP, tile_margin=TILE_MARGIN, registry=None,
+                 intra_op_threads=0, inter_op_threads=0, metrics=None, trace_dir=None, cache=None,
+                 scheduler_workers=1, max_batch=4, buckets=None, encode_preset=None, backend='auto'):
+        """
+        :param tile_size: run images larger than this through the model in overlapping tiles, None to disable.
+        :param tile_overlap: pixels shared by neighbouring tiles, feathered together to hide the seams.
+        :param tile_margin: pixels of the overlap next to an inner tile edge that are thrown away, the model's
+            zero padding reaches this far in; at least its receptive field radius, less than half tile_overlap.
+        :param registry: ModelRegistry keeping recently used models loaded, a private one holding 3 by default.
+        :param intra_op_threads: threads used inside one op by the session, 0 lets TensorFlow decide.
+        :param inter_op_threads: ops the session runs in parallel, 0 lets TensorFlow decide.
+        :param metrics: Metrics collecting per-stage timings, see Enhancer.metrics.
+        :param trace_dir: write a Chrome trace (chrome://tracing) of every session call into this directory.
+        :param cache: ResultCache, sample and batch_process reuse results of identical pixels, model and options.
+        :param scheduler_workers: threads running requests queued by submit.
+        :param max_batch: most submitted images of the same size merged into one session call.
+        :param buckets: pad inputs up to a few shapes and crop the results back, so the session sees
+            fewer distinct shapes and pays their first-run cost less often. An int rounds width and height
+            up to its multiple, a list of (width, height) picks the smallest one that fits.
+        :param encode_preset: speed versus size preset from encoding.PRESETS batch_process saves with,
+            None keeps OpenCV's defaults.
+        :param backend: what runs the model, a name from backends.BACKENDS or 'auto' to pick per model.
+            Tracing needs 'tensorflow', which auto prefers when trace_dir is set.
+        """
         self.gpu = gpu
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.tile_margin = tile_margin
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.trace_dir = trace_dir
+        self.cache = cache
+        self.scheduler_workers = scheduler_workers
+        self.max_batch = max_batch
+        self.buckets = buckets
+        self.encode_preset = encode_preset
+        self.backend = backend
+        self._scheduler = None
+        self._scheduler_lock = td.Lock()
+        self._trace_count = 0
+        self._trace_lock = td.Lock()
         self._files = []
         self._model = None
+        self.model_hash = None
         self._locked = False
-        self._sess = None
-        self._graph = _Graph()
+        self._backend = None
+        self._registry = registry if registry is not None else ModelRegistry()
         self._result = []
         self._available = True
         self.success = False
         self.error_log = ''
-        self.model_available = lambda: self._sess is not None
+        self.model_available = lambda: self._backend is not None
         if not gpu:
             os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
 
-    def _init_graph(self):
-        graph = tf.Graph()
-        with graph.as_default():
-            self._graph.image_ph = tf.placeholder(dtype=tf.float32, shape=(None, None, 3), name="ph")
-            self._graph.height = tf.placeholder(dtype=tf.int32)
-            self._graph.width = tf.placeholder(dtype=tf.int32)
-
-            input_image = tf.cast(self._graph.image_ph, dtype=tf.float32)
-            input_image = input_image / 127.5 - 1
-
-            with tf.gfile.GFile(self._model, 'rb') as model_file:
-                graph_def = tf.GraphDef()
-                graph_def.ParseFromString(model_file.read())
+    @property
+    def model_path(self):
+        """
+        Path of the loaded model, None before load_model.
+        """
+        return self._model
 
-            try:
-                self._graph.output_image = tf.import_graph_def(graph_def,
-                                                               input_map={'input_image': input_image},
-                                                               return_elements=['output_image:0'],
-                                                               name='output')
-                config = tf.ConfigProto()
-                config.gpu_options.allow_growth = True
-                self._sess = tf.Session(graph=graph, config=config)
+    @property
+    def backend_name(self):
+        """
+        Name of the backend running the loaded model (see backends.BACKENDS), None before load_model.
+        """
+        return None if self._backend is None else self._backend.name
 
-            except Exception as e:
-                try:
-                    self._sess.close()
-                    raise e
-                except Exception as e:
-                    self._sess = None
-                    raise e
+    def _load_backend(self, model_path):
+        def load(model_bytes):
+            backend = self.backend
+            if backend == 'auto' and self.trace_dir:
+                backend = 'tensorflow'
+            return load_backend(model_bytes, model_path, backend, gpu=self.gpu,
+                                intra_op_threads=self.intra_op_threads, inter_op_threads=self.inter_op_threads)
+        return load
 
     def close(self):
-        self._sess.close()
+        with self._scheduler_lock:
+            scheduler, self._scheduler = self._scheduler, None
+        if scheduler is not None:
+            scheduler.close()
+        self._registry.clear()
+        self._backend = None
         self._lock()
 
-    def load_model(self, model_path):
+    def load_model(self, model_path, warmup=None):
+        """
+        Switch to the model at model_path. Recently used models stay loaded in the registry,
+        switching back to one of them doesn't read or parse the file again.
+        :param warmup: [(width, height), ...] run once through the new backend so the first real image
+            of those sizes isn't slower than the rest, True for the buckets. Sizes the model already ran are skipped.
+        """
+        model = self._registry.get(model_path, self._load_backend(model_path))
         self._model = model_path
-        self._init_graph()
+        self.model_hash = self._registry.key(model_path)[1]
+        self._backend = model
+        if warmup is True:
+            warmup = self.buckets if not isinstance(self.buckets, int) else None
+            if not warmup:
+                logging.warning("nothing to warm up, buckets aren't a list of (width, height)")
+        for width, height in warmup or ():
+            if self._bucket_shape(height, width) not in model.shapes:
+                start = time.perf_counter()
+                self._run_batch(np.zeros((1, height, width, 3), dtype=np.uint8))
+                logging.info("warmed up %dx%d in %.2fs", width, height, time.perf_counter() - start)
         self._unlock()
 
     def add_files(self, file: dict):  # for batch process
         """
         :param file: {
             'path'          : str,  where's the file.
-            'denoise'       : bool, denoise before process.
-            'denoise_after' : bool, denoise after process.
+            'denoise'       : bool or str, denoise before process, True or a preset name from denoise.PRESETS.
+            'denoise_after' : bool or str, denoise after process, True or a preset name.
+            'save_path'     : str,  where to write the result.
+            'resize'        : (width, height), optional, 0 or None keeps the aspect ratio.
+            'tile_size'     : int,  optional, overrides Enhancer.tile_size, 0 to disable.
         }
         :return:
             self
@@ -81,65 +153,172 @@ class Enhancer:
     def is_available(self):
         return self._available
 
-    def batch_process(self):
+    def batch_process(self, workers=1, readers=2, writers=2, queue_depth=4, batch_size=1, max_batch_pixels=None):
+        """
+        Process every file queued by add_files.
+        Decoding, inference and encoding run as a pipeline so disk I/O and image coding
+        overlap with the session instead of waiting for it.
+        :param workers: threads feeding the session, it is shared between them.
+        :param readers: threads decoding and denoising input files.
+        :param writers: threads denoising, encoding and saving results.
+        :param queue_depth: decoded images or results allowed to wait between two stages.
+        :param batch_size: most images of the same size run through the session in one call.
+        :param max_batch_pixels: memory budget of one call, batches are split to stay below it.
+        :return:
+            [{'path': str, 'success': bool, 'pixels': int, 'error': str}, ...] in the order the files were added.
+        """
         self._available = False
+        try:
+            outputs = Pipeline([
+                Stage(self._read_file, readers, queue_depth),
+                Stage(lambda jobs: self._enhance_files(jobs, max_batch_pixels), workers,
+                      max(queue_depth, batch_size), batch_key=_batch_key, max_batch=max(1, batch_size)),
+                Stage(self._write_file, writers, queue_depth),
+            ]).run(self._files)
+        finally:
+            self._available = True
 
-        for file in self._files:
-            path = file['path']
-            save_path = file['save_path']
-            denoise = file['denoise']
-            denoise_after = file['denoise_after']
-            image = cv2.imread(path)
+        results = []
+        for output in outputs:
+            if isinstance(output, Failure):
+                path = output.item['path']
+                logging.error("Something went wrong with '%s'!", path)
+                logging.error(str(output.error))
+                result = {'path': path, 'success': False, 'pixels': 0, 'error': str(output.error)}
+                output = self.metrics.finish(output.item.get('timings', {}), **result)
+            results.append(output)
+
+        if results:
+            self.success = results[-1]['success']
+        return results
+
+    def _read_file(self, file):
+        path = file['path']
+        timings = {}
+        job = dict(file, timings=timings, denoise=resolve_preset(file['denoise'], 'standard'),
+                   denoise_after=resolve_preset(file['denoise_after'], 'standard'))
+        with self.metrics.stage('read', timings):
+            with open(path, 'rb') as f:
+                data = np.frombuffer(f.read(), dtype=np.uint8)
+        with self.metrics.stage('decode', timings):
+            image = cv2.imdecode(data, cv2.IMREAD_COLOR)
+        if image is None:
+            raise IOError("can't decode image '%s'" % path)
+        h, w, _ = image.shape
+        width, height = _resize_size(w, h, *(file.get('resize') or ()))
+
+        if (width, height) != (w, h):
+            # always on the host, an in-graph resize rounds differently and the cache or tiling would change the pixels
+            with self.metrics.stage('resize', timings):
+                image = resize_image(image, width, height)
+
+        job['cache_key'], cached = None, None
+        if self.cache is None and not job['denoise'] and not self._tiled(height, width, file.get('tile_size')):
+            # nothing else needs the pixels on the host, color conversion and crop run in the graph
+            job['image'] = image
+            job['preprocess'] = {'multiple': 4, 'bgr_in': True, 'bgr_out': not job['denoise_after']}
+            job['bgr'] = job['preprocess']['bgr_out']
+            return job
+
+        with self.metrics.stage('color', timings):
             image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            try:
-                h, w, _ = image.shape
-
-                if denoise:
-                    image = cv2.fastNlMeansDenoisingColored(image, None, 10, 10, 5, 5)
-
-                image = image[h % 4:, w % 4:, :]
-                h, w, _ = image.shape
-
-                [[[result_img]]] = self._sess.run([self._graph.output_image], feed_dict={
-                    self._graph.image_ph: image,
-                    self._graph.height: h,
-                    self._graph.width: w
-                })
-                result_img = np.asarray(result_img)
-
-                if denoise_after:
-                    result_img = cv2.fastNlMeansDenoisingColored(result_img, None, 10, 10, 5, 5)
-
+        h, w, _ = image.shape
+
+        if self.cache is not None:
+            with self.metrics.stage('cache', timings):
+                job['cache_key'] = self._cache_key(image, mode='batch', denoise=job['denoise'],
+                                                   denoise_after=job['denoise_after'],
+                                                   tile_size=file.get('tile_size'))
+                cached = self.cache.get(job['cache_key']) if job['cache_key'] else None
+        if cached is not None:
+            job['result'] = cached
+            job['cached'] = True
+            return job
+
+        if job['denoise']:
+            with self.metrics.stage('denoise', timings):
+                image = denoise_image(image, job['denoise'])
+
+        with self.metrics.stage('crop', timings):
+            job['image'] = image[h % 4:, w % 4:, :]
+        return job
+
+    def _enhance_files(self, jobs, max_batch_pixels=None):
+        if jobs[0].get('cached'):  # cache hits are grouped together, see _batch_key
+            return jobs
+        start = time.perf_counter()
+        images = self._enhance_batch([job.pop('image') for job in jobs], jobs[0].get('tile_size'), max_batch_pixels,
+                                     jobs[0].get('preprocess'))
+        seconds = (time.perf_counter() - start) / len(jobs)
+        for job in jobs:
+            self.metrics.record('inference', seconds, job['timings'])
+        return [dict(job, result=result_img) for job, result_img in zip(jobs, images)]
+
+    def _write_file(self, job):
+        path = job['path']
+        timings = job['timings']
+        result_img = job.pop('result')
+        cached = job.get('cached', False)
+        if not cached:
+            if job['denoise_after']:
+                with self.metrics.stage('denoise_after', timings):
+                    result_img = denoise_image(result_img, job['denoise_after'])
+            if job['cache_key']:
+                with self.metrics.stage('cache', timings):
+                    self.cache.put(job['cache_key'], result_img)
+
+        if not job.get('bgr'):
+            with self.metrics.stage('color', timings):
                 result_img = cv2.cvtColor(result_img, cv2.COLOR_RGB2BGR)
-                cv2.imwrite(save_path, result_img)
-                self.success = True
-
-            except Exception as e:
-                print("Something went wrong!")
-                print(str(e))
-                self.success = False
-
-        self._available = True
-
-    def sample(self, image, denoise=False, denoise_after=False):
+        with self.metrics.stage('encode', timings):
+            extension = os.path.splitext(job['save_path'])[1] or '.png'
+            ok, data = cv2.imencode(extension, result_img, cv2_params(extension, self.encode_preset))
+        if not ok:
+            raise IOError("can't encode image '%s'" % job['save_path'])
+        with self.metrics.stage('write', timings):
+            with open(job['save_path'], 'wb') as f:
+                f.write(data.tobytes())
+        return self.metrics.finish(timings, path=path, success=True, cached=cached,
+                                   pixels=result_img.shape[0] * result_img.shape[1], bytes=data.size, error='')
+
+    def sample(self, image, denoise=False, denoise_after=False, tile_size=None, resize=None, multiple=1):
+        """
+        Enhance image on the calling thread. success and error_log are shared by all callers,
+        threads enhancing concurrently should use submit instead.
+        :param denoise: True for the 'fine' preset, or a preset name from denoise.PRESETS.
+        :param denoise_after: True for the 'standard' preset, or a preset name.
+        :param resize: (width, height) to resize to first, 0 or None keeps the aspect ratio.
+        :param multiple: crop the top and left so both sides are a multiple of it.
+            Cropping happens in the graph unless the image is denoised before or tiled.
+        :return:
+            the enhanced image, None on failure with the reason in error_log.
+        """
         image = image[:,:,:3]
         self._available = False
+        timings = {}
         try:
-            h, w, _ = image.shape
-            if denoise:
-                image = cv2.fastNlMeansDenoisingColored(image, None, 5, 5, 7, 21)
-
-            h, w, _ = image.shape
-
-            [[[result_img]]] = self._sess.run([self._graph.output_image], feed_dict={
-                self._graph.image_ph: image,
-                self._graph.height: h,
-                self._graph.width: w
-            })
-            result_img = np.asarray(result_img)
-
-            if denoise_after:
-                result_img = cv2.fastNlMeansDenoisingColored(result_img, None, 10, 10, 5, 5)
+            denoise = resolve_preset(denoise, 'fine')
+            denoise_after = resolve_preset(denoise_after, 'standard')
+            h, w = image.shape[:2]
+            width, height = _resize_size(w, h, *(resize or ()))
+            if (width, height) != (w, h):  # on the host whatever the path, see _read_file
+                with self.metrics.stage('resize', timings):
+                    image = resize_image(image, width, height)
+            preprocess = None
+            if denoise or self._tiled(height, width, tile_size):
+                image = image[height % multiple:, width % multiple:]
+            else:
+                preprocess = {'multiple': multiple} if multiple != 1 else {}
+
+            key, result_img, image = self._prepare(image, timings, denoise, denoise_after, tile_size,
+                                                   **(preprocess or {}))
+            if result_img is None:
+                with self.metrics.stage('inference', timings):
+                    if preprocess is not None:
+                        result_img = self._run_batch(image[np.newaxis], **preprocess)[0]
+                    else:
+                        result_img = self._enhance(image, tile_size)
+            result_img = self._finish(result_img, timings, key, denoise_after, cached=image is None)
             self.error_log = ''
             self.success = True
             return result_img
@@ -149,11 +328,249 @@ class Enhancer:
             logging.error(str(e))
             self.success = False
             self.error_log = str(e)
+            self.metrics.finish(timings, success=False, pixels=0, error=str(e))
             return None
 
         finally:
             self._available = True
 
+    def enhance_array(self, image, tile_size=None):
+        """
+        Enhance an RGB image, tiled when it is larger than tile_size, for callers doing their own
+        reading, writing and bookkeeping such as largeimage.py. Nothing is cached or recorded in metrics.
+        :param tile_size: overrides Enhancer.tile_size, 0 never tiles.
+        :return:
+            the enhanced image, raises on failure.
+        """
+        return self._enhance(np.ascontiguousarray(image[:, :, :3]), tile_size)
+
+    def enhance_batch(self, images, tile_size=None, multiple=1, bgr_in=False, bgr_out=False):
+        """
+        Enhance same-sized images the way batch_process does, in as few backend calls as possible, for callers
+        doing their own reading, writing and bookkeeping such as benchmark.py. Nothing is cached or recorded
+        in metrics. Cropping and color conversion run in the backend unless the images are tiled.
+        :param images: list or (n, h, w, 3) array of uint8 images.
+        :param multiple: crop the top and left so both sides are a multiple of it.
+        :param bgr_in: images are BGR.
+        :param bgr_out: return BGR.
+        :return:
+            results in the order of images, raises on failure.
+        """
+        h, w = images[0].shape[:2]
+        if self._tiled(h, w, tile_size):
+            images = [image[h % multiple:, w % multiple:] for image in images]
+            if bgr_in:
+                images = [cv2.cvtColor(image, cv2.COLOR_BGR2RGB) for image in images]
+            results = self._enhance_batch(images, tile_size)
+            return [cv2.cvtColor(result_img, cv2.COLOR_RGB2BGR) for result_img in results] if bgr_out else results
+        return self._enhance_batch(list(images), tile_size,
+                                   preprocess={'multiple': multiple, 'bgr_in': bgr_in, 'bgr_out': bgr_out})
+
+    def enhance_frames(self, frames, tile_size=None):
+        """
+        Enhance same-sized BGR video frames into BGR results, see enhance_batch. The top and left are
+        cropped to a multiple of 4 like batch_process does.
+        """
+        return self.enhance_batch(frames, tile_size, multiple=4, bgr_in=True, bgr_out=True)
+
+    def submit(self, image, denoise=False, denoise_after=False, tile_size=None, priority=PRIORITY_NORMAL):
+        """
+        Queue image to be enhanced by the scheduler, safe to call from any thread.
+        Waiting requests of the same size are merged into one session call.
+        :param denoise: see sample.
+        :param denoise_after: see sample.
+        :param priority: lower runs first, scheduler.PRIORITY_INTERACTIVE goes ahead of PRIORITY_BATCH.
+        :return:
+            concurrent.futures.Future of the enhanced image, raising the error on failure.
+            asyncio code can await asyncio.wrap_future(future).
+        """
+        image = image[:, :, :3]
+        options = {'denoise': resolve_preset(denoise, 'fine'),
+                   'denoise_after': resolve_preset(denoise_after, 'standard'),
+                   'tile_size': tile_size}
+        batch_key = None if self._tiled(*image.shape[:2], tile_size) else (image.shape, tile_size)
+        with self._scheduler_lock:
+            if self._scheduler is None:
+                self._scheduler = Scheduler(self._run_requests, self.scheduler_workers, self.max_batch)
+            scheduler = self._scheduler
+        return scheduler.submit(Request(image, options, priority, batch_key))
+
+    def queue_depth(self):
+        """
+        :return:
+            requests submitted but not started yet.
+        """
+        return self._scheduler.queue_depth() if self._scheduler is not None else 0
+
+    def _run_requests(self, requests):
+        """
+        Run by the scheduler with requests of equal batch keys.
+        :return:
+            the enhanced image or the exception for every request.
+        """
+        results = [None] * len(requests)
+        pending = []
+        for i, request in enumerate(requests):
+            timings = {}
+            try:
+                key, result_img, image = self._prepare(request.image, timings, **request.options)
+                if result_img is not None:
+                    results[i] = self._finish(result_img, timings, key, None, cached=True)
+                else:
+                    pending.append((i, request, key, image, timings))
+            except Exception as e:
+                results[i] = e
+                self.metrics.finish(timings, success=False, pixels=0, error=str(e))
+        if not pending:
+            return results
+
+        try:
+            start = time.perf_counter()
+            images = self._enhance_batch([image for _, _, _, image, _ in pending], pending[0][1].options['tile_size'])
+            seconds = (time.perf_counter() - start) / len(pending)
+        except Exception as e:
+            images, seconds = [e] * len(pending), 0.
+        for (i, request, key, _, timings), result_img in zip(pending, images):
+            self.metrics.record('inference', seconds, timings)
+            try:
+                if isinstance(result_img, Exception):
+                    raise result_img
+                results[i] = self._finish(result_img, timings, key, request.options['denoise_after'])
+            except Exception as e:
+                results[i] = e
+                self.metrics.finish(timings, success=False, pixels=0, error=str(e))
+        return results
+
+    def _prepare(self, image, timings, denoise=None, denoise_after=None, tile_size=None, **params):
+        """
+        Cache lookup and denoise before enhancing, shared by sample and submit.
+        :param params: further options the result depends on, part of the cache key.
+        :return:
+            (cache key, cached result or None, image to enhance or None when cached)
+        """
+        key, result_img = None, None
+        if self.cache is not None:
+            with self.metrics.stage('cache', timings):
+                key = self._cache_key(image, mode='sample', denoise=denoise, denoise_after=denoise_after,
+                                      tile_size=tile_size, **params)
+                result_img = self.cache.get(key) if key else None
+        if result_img is not None:
+            return key, result_img, None
+
+        if denoise:
+            with self.metrics.stage('denoise', timings):
+                image = denoise_image(image, denoise)
+        return key, None, image
+
+    def _finish(self, result_img, timings, key=None, denoise_after=None, cached=False):
+        if not cached:
+            if denoise_after:
+                with self.metrics.stage('denoise_after', timings):
+                    result_img = denoise_image(result_img, denoise_after)
+            if key:
+                self.cache.put(key, result_img)
+        self.metrics.finish(timings, success=True, cached=cached,
+                            pixels=result_img.shape[0] * result_img.shape[1], error='')
+        return result_img
+
+    def _cache_key(self, image, tile_size=None, **params):
+        """
+        :return:
+            the result cache key of enhancing image with the current model, None when there's nothing to cache in.
+        """
+        if self.cache is None or self.model_hash is None:
+            return None
+        tile_size = self.tile_size if tile_size is None else tile_size
+        if self.buckets:  # padding changes the pixels next to the border
+            params['buckets'] = self.buckets
+        if self._backend is not None and self._backend.name != 'tensorflow':  # rounds differently
+            params['backend'] = self._backend.name
+        return self.cache.key(image, self.model_hash, tile_size=tile_size,
+                              tile_overlap=self.tile_overlap if tile_size else None,
+                              tile_margin=self.tile_margin if tile_size else None, **params)
+
+    def _tiled(self, h, w, tile_size=None):
+        tile_size = self.tile_size if tile_size is None else tile_size
+        return bool(tile_size) and max(h, w) > tile_size
+
+    def _enhance(self, image, tile_size=None):
+        tile_size = self.tile_size if tile_size is None else tile_size
+        h, w, _ = image.shape
+        if self._tiled(h, w, tile_size):
+            return blend_tiles(image, tile_size, self.tile_overlap, self._run, multiple=TILE_MULTIPLE,
+                               margin=self.tile_margin)
+        return self._run(image)
+
+    def _enhance_batch(self, images, tile_size=None, max_batch_pixels=None, preprocess=None):
+        """
+        Enhance same-sized images, as few session calls as max_batch_pixels allows.
+        :param preprocess: _run_batch options, the images are never tiled then.
+        """
+        h, w, _ = images[0].shape
+        if not preprocess and (len(images) == 1 or self._tiled(h, w, tile_size)):
+            return [self._enhance(image, tile_size) for image in images]
+
+        per_call = len(images) if not max_batch_pixels else max(1, max_batch_pixels // (h * w))
+        results = []
+        for start in range(0, len(images), per_call):
+            chunk = images[start:start + per_call]
+            batch = chunk[0][np.newaxis] if len(chunk) == 1 else np.stack(chunk)
+            results += list(self._run_batch(batch, **(preprocess or {})))
+        return results
+
+    def _run(self, image):
+        return self._run_batch(image[np.newaxis])[0]
+
+    def _bucket_shape(self, h, w):
+        """
+        :return:
+            (height, width) the session runs an h x w input at, see buckets.
+        """
+        if not self.buckets:
+            return h, w
+        if isinstance(self.buckets, int):
+            return -(-h // self.buckets) * self.buckets, -(-w // self.buckets) * self.buckets
+        fits = [(height, width) for width, height in self.buckets if height >= h and width >= w]
+        return min(fits, key=lambda shape: shape[0] * shape[1]) if fits else (h, w)
+
+    def _run_batch(self, images, size=None, multiple=1, bgr_in=False, bgr_out=False):
+        """
+        Run one backend call. With TensorFlow the optional steps run inside the graph, so the decoded buffer
+        is fed as it is and the final image comes back without copies on the host; see backends for the others.
+        :param images: (n, h, w, 3) uint8.
+        :param size: (width, height) to resize to first.
+        :param multiple: crop the top and left so both sides are a multiple of it.
+        :param bgr_in: images are BGR.
+        :param bgr_out: return BGR.
+        """
+        _, h, w, _ = images.shape
+        width, height = size or (w, h)
+        height, width = height - height % multiple, width - width % multiple
+        padded_h, padded_w = self._bucket_shape(height, width)
+        pad_h, pad_w, crop = padded_h - height, padded_w - width, False
+        if pad_h > height or pad_w > width:  # mirror padding in the graph reflects at most the image itself
+            if size is None and multiple == 1:
+                images = np.pad(images, ((0, 0), (0, pad_h), (0, pad_w), (0, 0)), mode='symmetric')
+                crop = True
+            else:
+                padded_h, padded_w = height, width
+            pad_h, pad_w = 0, 0
+
+        result_imgs = self._backend.run(images, size, multiple, pad_h, pad_w, bgr_in, bgr_out,
+                                        trace=self._write_trace if self.trace_dir else None)
+        self._backend.shapes.add((padded_h, padded_w))
+        return result_imgs[:, :height, :width] if crop else result_imgs
+
+    def _write_trace(self, run_metadata):
+        from tensorflow.python.client import timeline
+
+        with self._trace_lock:
+            self._trace_count += 1
+            path = os.path.join(self.trace_dir, 'step_%05d.json' % self._trace_count)
+        os.makedirs(self.trace_dir, exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format())
+
     def _lock(self):
         self._available = False
 
@@ -161,12 +578,27 @@ class Enhancer:
         self._available = True
 
 
-class _Graph:
-    def __init__(self):
-        self.output_image = None
-        self.image_ph = None
-        self.height = None
-        self.width = None
+def _batch_key(job):
+    if job.get('cached'):
+        return 'cached'
+    return job['image'].shape, job.get('tile_size'), tuple(sorted(job.get('preprocess', {}).items()))
+
+
+def resize_image(image, width=None, height=None):
+    """
+    Resize to width x height, a missing side keeps the aspect ratio.
+    """
+    h, w = image.shape[:2]
+    width, height = _resize_size(w, h, width, height)
+    if (width, height) == (w, h):
+        return image
+    return cv2.resize(image, dsize=(width, height))
+
+
+def _resize_size(w, h, width=None, height=None):
+    if not width and not height:
+        return w, h
+    return width or max(1, int(w * height / h)), height or max(1, int(h * width / w))
 
 
 def add_gaussian_noise(image, mean=0, std=0.001):
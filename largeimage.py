@@ -0,0 +1,313 @@
+import logging
+import os
+import struct
+import tempfile
+import time
+import zlib
+from contextlib import contextmanager
+
+import numpy as np
+
+from tiling import iter_blended_rows
+
+LARGE_TILE = 512
+PNG_CHUNK = 1 << 20
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_STRIP_BYTES = 64 << 20  # filtered rows decoded at a time by read_png
+# channels of the raw PNG color types read_png handles, and where they are in what OpenCV decodes
+PNG_CHANNELS = {0: [0], 2: [2, 1, 0], 4: [0, 3], 6: [2, 1, 0, 3]}
+OPENCV_MAX_PIXELS = 1 << 30
+TIFF_TILE = 256
+STREAM_EXTENSIONS = ('.png', '.tif', '.tiff', '.npy')
+
+
+def image_size(path):
+    """
+    (width, height) read from the header only.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.npy':
+        h, w = np.load(path, mmap_mode='r').shape[:2]
+        return w, h
+    from PIL import Image
+
+    limit, Image.MAX_IMAGE_PIXELS = Image.MAX_IMAGE_PIXELS, None  # large images are the point here
+    try:
+        with Image.open(path) as image:
+            return image.size
+    finally:
+        Image.MAX_IMAGE_PIXELS = limit
+
+
+def _tifffile():
+    try:
+        import tifffile
+    except ImportError:
+        raise ImportError("streaming TIFF files needs tifffile, install it with 'pip3 install tifffile' "
+                          "or use PNG or .npy instead")
+    return tifffile
+
+
+def _png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+
+def _png_chunks(f, path):
+    if f.read(8) != PNG_SIGNATURE:
+        raise IOError("'%s' isn't a PNG file" % path)
+    while True:
+        head = f.read(8)
+        if len(head) < 8:
+            raise IOError("'%s' is truncated" % path)
+        length, kind = struct.unpack('>I4s', head)
+        data = f.read(length)
+        f.read(4)  # CRC, OpenCV checks it on every strip anyway
+        yield kind, data
+        if kind == b'IEND':
+            return
+
+
+def _decode_png_strip(header, block, rows, prior):
+    """
+    Let OpenCV unfilter rows of filtered scanlines: they are wrapped into a small uncompressed PNG,
+    after the unfiltered last row of the previous strip their filters may refer to.
+    :return:
+        (RGB uint8 rows, raw bytes of the last row)
+    """
+    import cv2
+
+    width, _, depth, color = struct.unpack('>IIBB', header[:10])
+    data = block if prior is None else b'\0' + prior + block
+    png = (PNG_SIGNATURE + _png_chunk(b'IHDR', struct.pack('>II', width, rows + (prior is not None)) + header[8:])
+           + _png_chunk(b'IDAT', zlib.compress(data, 0)) + _png_chunk(b'IEND', b''))
+    decoded = cv2.imdecode(np.frombuffer(png, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    if decoded is None:
+        raise IOError("can't decode a strip of the PNG")
+    if decoded.ndim == 2:
+        decoded = decoded[:, :, np.newaxis]
+    if prior is not None:
+        decoded = decoded[1:]
+
+    last = decoded[-1][:, PNG_CHANNELS[color]]
+    last = (last.astype('>u2') if depth == 16 else last).tobytes()
+    rgb = decoded[:, :, [2, 1, 0]] if decoded.shape[2] >= 3 else np.repeat(decoded[:, :, :1], 3, axis=2)
+    if depth == 16:
+        rgb = (rgb >> 8).astype(np.uint8)
+    return rgb, last
+
+
+def read_png(path, out, strip=1024):
+    """
+    Decode a PNG into out, an (h, w, 3) uint8 array (usually a np.memmap), a strip of rows at a time.
+    The image data is inflated here and each strip is unfiltered by OpenCV, so no more than
+    PNG_STRIP_BYTES of it is in memory and OpenCV's own size limit doesn't apply.
+    8 and 16 bit gray, RGB and their alpha variants are supported, the alpha is dropped.
+    """
+    with open(path, 'rb') as f:
+        chunks = _png_chunks(f, path)
+        kind, header = next(chunks)
+        width, height, depth, color, _, _, interlace = struct.unpack('>IIBBBBB', header)
+        if kind != b'IHDR' or color not in PNG_CHANNELS or depth not in (8, 16) or interlace:
+            raise ValueError("'%s' is a palette, interlaced or below 8 bit PNG, which can't be decoded in strips; "
+                             "save it as an 8 bit RGB PNG, a TIFF or .npy" % path)
+        stride = 1 + width * len(PNG_CHANNELS[color]) * depth // 8
+        rows = max(1, min(strip, PNG_STRIP_BYTES // stride))
+        inflate = zlib.decompressobj()
+
+        def inflated():
+            for kind, data in chunks:
+                if kind != b'IDAT':
+                    continue
+                while data:  # bounded, a few bytes of a flat image can inflate to gigabytes
+                    yield inflate.decompress(data, PNG_STRIP_BYTES)
+                    data = inflate.unconsumed_tail
+            yield inflate.flush()
+
+        buffer, prior, y = bytearray(), None, 0
+        for data in inflated():
+            buffer += data
+            while y < height and len(buffer) >= min(rows, height - y) * stride:
+                n = min(rows, height - y)
+                out[y:y + n], prior = _decode_png_strip(header, bytes(buffer[:n * stride]), n, prior)
+                del buffer[:n * stride]
+                y += n
+        if y < height:
+            raise IOError("'%s' is truncated" % path)
+
+
+def _as_rgb(image):
+    if image.ndim == 2:
+        return np.repeat(image[:, :, np.newaxis], 3, axis=2)
+    return image[:, :, :3]
+
+
+@contextmanager
+def open_image(path, scratch_dir=None, strip=1024):
+    """
+    Open a large image as an (h, w, c) array that is paged from disk instead of held in memory.
+    .npy files are memory-mapped as they are; TIFF files are memory-mapped when stored uncompressed
+    and decoded segment by segment into a scratch file otherwise (needs tifffile); PNG files are decoded
+    into a scratch file strip by strip, see read_png. Other formats are decoded once with OpenCV and
+    copied into a scratch file, so the decoded 8 bit image is the only full copy ever in memory.
+    :param scratch_dir: where temporary files go, the system default when None.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.npy':
+        yield np.load(path, mmap_mode='r')
+        return
+
+    fd, scratch = tempfile.mkstemp(suffix='.raw', dir=scratch_dir)
+    os.close(fd)
+    try:
+        if ext in ('.tif', '.tiff'):
+            tifffile = _tifffile()
+            try:
+                image = tifffile.memmap(path, mode='r')
+            except ValueError:  # compressed or not contiguous
+                image = tifffile.imread(path, out=scratch)
+            yield image
+        elif ext == '.png':
+            width, height = image_size(path)
+            image = np.memmap(scratch, dtype=np.uint8, mode='w+', shape=(height, width, 3))
+            read_png(path, image, strip)
+            image.flush()
+            yield image
+        else:
+            import cv2
+
+            width, height = image_size(path)
+            if width * height >= OPENCV_MAX_PIXELS:
+                raise ValueError("'%s' is too large for OpenCV to decode, save it as PNG, TIFF or .npy to stream it"
+                                 % path)
+            logging.warning("'%s' can't be decoded in strips, it is decoded in memory once", path)
+            decoded = cv2.imread(path, cv2.IMREAD_COLOR)
+            if decoded is None:
+                raise IOError("can't decode image '%s'" % path)
+            image = np.memmap(scratch, dtype=np.uint8, mode='w+', shape=decoded.shape)
+            for y in range(0, decoded.shape[0], strip):
+                image[y:y + strip] = cv2.cvtColor(decoded[y:y + strip], cv2.COLOR_BGR2RGB)
+            del decoded
+            image.flush()
+            yield image
+    finally:
+        try:
+            os.remove(scratch)
+        except OSError:
+            pass
+
+
+def write_png(path, width, height, rows, level=6):
+    """
+    Write RGB rows to a PNG as they arrive, each row is filtered and compressed straight into IDAT chunks.
+    :param rows: iterable of (y, (n, width, 3) uint8 block) in order.
+    """
+    def chunk(kind, data):
+        f.write(_png_chunk(kind, data))
+
+    compressor = zlib.compressobj(level)
+    previous = np.zeros(width * 3, dtype=np.uint8)
+    pending = b''
+    with open(path, 'wb') as f:
+        f.write(PNG_SIGNATURE)
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+        for _, block in rows:
+            block = np.ascontiguousarray(block).reshape(len(block), width * 3)
+            above = np.vstack([previous[np.newaxis], block[:-1]])
+            filtered = np.hstack([np.full((len(block), 1), 2, dtype=np.uint8), block - above])  # 'Up' filter
+            pending += compressor.compress(filtered.tobytes())
+            previous = block[-1].copy()
+            if len(pending) >= PNG_CHUNK:
+                chunk(b'IDAT', pending)
+                pending = b''
+        chunk(b'IDAT', pending + compressor.flush())
+        chunk(b'IEND', b'')
+
+
+def write_tiff(path, width, height, rows, tile=TIFF_TILE, compression='zlib'):
+    """
+    Write RGB rows to a tiled TIFF, a band of tile rows is buffered and handed over tile by tile. Needs tifffile.
+    """
+    tifffile = _tifffile()
+
+    def tiles():
+        band = np.zeros((tile, width, 3), dtype=np.uint8)
+        filled = 0
+        for _, block in rows:
+            while len(block):
+                n = min(tile - filled, len(block))
+                band[filled:filled + n] = block[:n]
+                filled += n
+                block = block[n:]
+                if filled == tile:
+                    yield from split(band)
+                    filled = 0
+        if filled:
+            band[filled:] = 0
+            yield from split(band)
+
+    def split(band):
+        for x in range(0, width, tile):
+            piece = np.zeros((tile, tile, 3), dtype=np.uint8)
+            piece[:, :min(tile, width - x)] = band[:, x:x + tile]
+            yield piece
+
+    tifffile.imwrite(path, tiles(), shape=(height, width, 3), dtype=np.uint8, tile=(tile, tile),
+                     photometric='rgb', compression=compression, bigtiff=width * height * 3 >= 1 << 32)
+
+
+def write_npy(path, width, height, rows):
+    result = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(height, width, 3))
+    for y, block in rows:
+        result[y:y + len(block)] = block
+    result.flush()
+    del result
+
+
+def write_image(path, width, height, rows):
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.png':
+        write_png(path, width, height, rows)
+    elif ext in ('.tif', '.tiff'):
+        write_tiff(path, width, height, rows)
+    elif ext == '.npy':
+        write_npy(path, width, height, rows)
+    else:
+        raise ValueError("'%s' can't be written in strips, use one of %s" % (ext, ', '.join(STREAM_EXTENSIONS)))
+
+
+def enhance_large(enhancer, path, save_path, tile_size=None, scratch_dir=None):
+    """
+    Enhance an image too large for memory: the input is paged from disk, tiles are blended band by band
+    and finished rows are written out immediately, so neither the full input nor the full result is ever held.
+    Denoise and resize options of batch_process don't apply here.
+    :param tile_size: defaults to the enhancer's, or LARGE_TILE.
+    :return:
+        the same record batch_process returns for a file.
+    """
+    from enhancer import TILE_MULTIPLE
+
+    tile_size = tile_size or enhancer.tile_size or LARGE_TILE
+    temp_path = save_path + '.tmp' + os.path.splitext(save_path)[1]
+    timings = {}
+    try:
+        start = time.perf_counter()
+        with open_image(path, scratch_dir) as image:
+            enhancer.metrics.record('decode', time.perf_counter() - start, timings)
+            h, w = image.shape[:2]
+
+            def run(tile):
+                with enhancer.metrics.stage('inference', timings):
+                    return enhancer.enhance_array(_as_rgb(tile), tile_size=0)  # already a tile
+
+            start = time.perf_counter()
+            write_image(temp_path, w, h, iter_blended_rows(image, tile_size, enhancer.tile_overlap, run,
+                                                           multiple=TILE_MULTIPLE, margin=enhancer.tile_margin))
+            os.replace(temp_path, save_path)
+            enhancer.metrics.record('write', time.perf_counter() - start - timings.get('inference', 0.), timings)
+    except Exception as e:
+        logging.error("Something went wrong with '%s'!", path)
+        logging.error(str(e))
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return enhancer.metrics.finish(timings, path=path, success=False, pixels=0, error=str(e))
+    return enhancer.metrics.finish(timings, path=path, success=True, pixels=h * w, error='')
@@ -0,0 +1,69 @@
+import threading as td
+import time
+from contextlib import contextmanager
+
+
+class Metrics:
+    """
+    Per-stage timings of Enhancer calls. Every call gets its own timings dict,
+    which is added to the running totals and handed to the callback when the call finishes.
+    """
+
+    def __init__(self, callback=None):
+        """
+        :param callback: called with {'stages': {stage: seconds}, 'success': bool, ...} after each image.
+        """
+        self.callback = callback
+        self._lock = td.Lock()
+        self._totals = {}
+
+    @contextmanager
+    def stage(self, name, timings):
+        """
+        Time the with-block as stage name of the call timings belongs to.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, timings)
+
+    def record(self, name, seconds, timings=None):
+        if timings is not None:
+            timings[name] = timings.get(name, 0.) + seconds
+        with self._lock:
+            count, total, longest = self._totals.get(name, (0, 0., 0.))
+            self._totals[name] = (count + 1, total + seconds, max(longest, seconds))
+
+    def finish(self, timings, **info):
+        """
+        :return:
+            the call record passed to the callback.
+        """
+        call = dict(info, stages=dict(timings))
+        if self.callback is not None:
+            self.callback(call)
+        return call
+
+    def summary(self):
+        """
+        :return:
+            {stage: {'count': int, 'total': seconds, 'mean': seconds, 'max': seconds}}
+        """
+        with self._lock:
+            return {name: {'count': count, 'total': total, 'mean': total / count, 'max': longest}
+                    for name, (count, total, longest) in self._totals.items()}
+
+    def reset(self):
+        with self._lock:
+            self._totals = {}
+
+    def format(self):
+        summary = self.summary()
+        grand_total = sum(stage['total'] for stage in summary.values()) or 1
+        lines = ["%-14s %6s %10s %10s %10s %6s" % ('stage', 'count', 'total s', 'mean ms', 'max ms', 'share')]
+        for name, stage in sorted(summary.items(), key=lambda item: -item[1]['total']):
+            lines.append("%-14s %6d %10.2f %10.1f %10.1f %5.1f%%" % (
+                name, stage['count'], stage['total'], stage['mean'] * 1e3, stage['max'] * 1e3,
+                stage['total'] / grand_total * 100))
+        return '\n'.join(lines)
@@ -0,0 +1,206 @@
+import logging
+import os
+import statistics
+import time
+
+import numpy as np
+import tensorflow as tf
+
+WEIGHT_TYPES = ('float32', 'float16', 'int8')
+TRANSFORMS = [
+    'remove_nodes(op=Identity, op=CheckNumerics, op=StopGradient)',
+    'fold_constants(ignore_errors=true)',
+    'fold_batch_norms',
+    'fold_old_batch_norms',
+    'strip_unused_nodes',
+    'sort_by_execution_order',
+]
+# smaller constants (biases, shapes) stay float32, converting them saves nothing
+MIN_WEIGHT_ELEMENTS = 1024
+
+
+def _read_graph_def(path):
+    graph_def = tf.GraphDef()
+    with open(path, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    return graph_def
+
+
+def _find_node(graph_def, name):
+    for node in graph_def.node:
+        if node.name == name:
+            return node
+    raise ValueError("model has no '%s' node" % name)
+
+
+def fold_input(graph_def):
+    """
+    Put the uint8 -> -1 ~ +1 conversion Enhancer used to add in front of the model into the graph,
+    so 'input_image' takes raw uint8 pixels.
+    """
+    source = _find_node(graph_def, 'input_image')
+    if source.attr['dtype'].type == tf.uint8.as_datatype_enum:
+        return graph_def
+
+    graph = tf.Graph()
+    with graph.as_default():
+        image = tf.placeholder(dtype=tf.uint8, shape=tf.TensorShape(source.attr['shape'].shape), name='input_image')
+        normalized = tf.cast(image, dtype=tf.float32) / 127.5 - 1
+        [output_image] = tf.import_graph_def(graph_def, input_map={'input_image': normalized},
+                                             return_elements=['output_image:0'], name='model')
+        tf.identity(output_image, name='output_image')
+    return graph.as_graph_def()
+
+
+def strip_and_fold(graph_def):
+    """
+    Drop training-only and unused nodes, fold constants and batch norms.
+    Without the graph transform tool (TensorFlow builds lacking tensorflow.tools.graph_transforms)
+    only training nodes and unused nodes are removed.
+    """
+    input_node = _find_node(graph_def, 'input_image')
+    try:
+        from tensorflow.tools.graph_transforms import TransformGraph
+    except ImportError:
+        logging.warning("graph transforms unavailable, constants and batch norms are not folded")
+        graph_def = tf.graph_util.remove_training_nodes(graph_def, protected_nodes=['input_image', 'output_image'])
+        return tf.graph_util.extract_sub_graph(graph_def, ['output_image'])
+
+    graph_def = TransformGraph(graph_def, ['input_image'], ['output_image'], TRANSFORMS)
+    # strip_unused_nodes recreates the input placeholder without its shape, Enhancer needs the rank
+    _find_node(graph_def, 'input_image').CopyFrom(input_node)
+    return graph_def
+
+
+def convert_weights(graph_def, weights):
+    """
+    Store large float32 constants as float16 or int8 and convert them back to float32 in the graph,
+    the file shrinks while every op still computes in float32. The conversion ops are constant folded
+    when the session starts, so inference speed is unchanged.
+    :param weights: one of WEIGHT_TYPES.
+    """
+    if weights == 'float32':
+        return graph_def
+    if weights not in WEIGHT_TYPES:
+        raise ValueError("unknown weight type '%s', expected one of %s" % (weights, ', '.join(WEIGHT_TYPES)))
+
+    result = tf.GraphDef()
+    result.CopyFrom(graph_def)
+    for node in list(result.node):
+        if node.op != 'Const' or node.attr['dtype'].type != tf.float32.as_datatype_enum:
+            continue
+        values = tf.make_ndarray(node.attr['value'].tensor)
+        if values.size < MIN_WEIGHT_ELEMENTS:
+            continue
+
+        if weights == 'float16':
+            stored, scale = values.astype(np.float16), None
+        else:
+            scale = float(np.abs(values).max()) / 127 or 1.
+            stored = np.round(values / scale).astype(np.int8)
+
+        constant = result.node.add()
+        constant.name = node.name + '/' + weights
+        constant.op = 'Const'
+        constant.device = node.device
+        constant.attr['dtype'].type = tf.as_dtype(stored.dtype).as_datatype_enum
+        constant.attr['value'].tensor.CopyFrom(tf.make_tensor_proto(stored))
+
+        cast = node if scale is None else result.node.add()
+        cast.name = node.name if scale is None else node.name + '/cast'
+        cast.op = 'Cast'
+        cast.device = node.device
+        cast.attr.clear()
+        cast.attr['SrcT'].type = constant.attr['dtype'].type
+        cast.attr['DstT'].type = tf.float32.as_datatype_enum
+        del cast.input[:]
+        cast.input.append(constant.name)
+
+        if scale is not None:
+            factor = result.node.add()
+            factor.name = node.name + '/scale'
+            factor.op = 'Const'
+            factor.device = node.device
+            factor.attr['dtype'].type = tf.float32.as_datatype_enum
+            factor.attr['value'].tensor.CopyFrom(tf.make_tensor_proto(np.float32(scale)))
+
+            node.op = 'Mul'
+            node.attr.clear()
+            node.attr['T'].type = tf.float32.as_datatype_enum
+            node.input.extend([cast.name, factor.name])
+    return result
+
+
+def optimize_model(source, target, weights='float32', fold_preprocessing=True):
+    """
+    Rewrite a frozen model into a leaner one Enhancer.load_model loads directly.
+    :param weights: storage type of the weights, one of WEIGHT_TYPES.
+    :param fold_preprocessing: make 'input_image' take uint8 pixels, see fold_input.
+    :return:
+        {'source_bytes': int, 'target_bytes': int, 'source_nodes': int, 'target_nodes': int}
+    """
+    graph_def = _read_graph_def(source)
+    source_nodes = len(graph_def.node)
+    if fold_preprocessing:
+        graph_def = fold_input(graph_def)
+    graph_def = strip_and_fold(graph_def)
+    graph_def = convert_weights(graph_def, weights)
+
+    temp_path = target + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    os.replace(temp_path, target)
+    return {
+        'source_bytes': os.path.getsize(source),
+        'target_bytes': os.path.getsize(target),
+        'source_nodes': source_nodes,
+        'target_nodes': len(graph_def.node),
+    }
+
+
+def measure(path, image, repeat=3, gpu=False):
+    """
+    Time loading a model into Enhancer and enhancing image with it.
+    :return:
+        ({'load_seconds': float, 'run_seconds': float}, enhanced image)
+    """
+    from enhancer import Enhancer
+
+    enhancer = Enhancer(gpu=gpu, backend='tensorflow')  # the graph rewrites are what's compared
+    try:
+        start = time.perf_counter()
+        enhancer.load_model(path)
+        load_seconds = time.perf_counter() - start
+        result = enhancer.enhance_array(image)  # warm up, the first call also builds the kernels
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            enhancer.enhance_array(image)
+            samples.append(time.perf_counter() - start)
+    finally:
+        enhancer.close()
+    return {'load_seconds': load_seconds, 'run_seconds': statistics.median(samples)}, result
+
+
+def compare_models(source, target, width=512, height=512, repeat=3, gpu=False):
+    """
+    Run both models on the same synthetic image. A throwaway load first pays TensorFlow's one-time
+    initialization, then each model is measured repeat times in alternating order.
+    :return:
+        {'source': timing, 'target': timing, 'max_difference': largest pixel difference of the outputs},
+        timings are medians of the measurements.
+    """
+    from benchmark import synthetic_image
+
+    image = synthetic_image(width - width % 4, height - height % 4)
+    measure(source, image, 1, gpu)
+    paths = {'source': source, 'target': target}
+    timings, results = {'source': [], 'target': []}, {}
+    for i in range(repeat):
+        for name in ('source', 'target') if i % 2 == 0 else ('target', 'source'):
+            timing, results[name] = measure(paths[name], image, repeat, gpu)
+            timings[name].append(timing)
+    report = {name: {key: statistics.median(timing[key] for timing in samples) for key in samples[0]}
+              for name, samples in timings.items()}
+    difference = np.abs(results['source'].astype(np.int16) - results['target'].astype(np.int16)).max()
+    return dict(report, max_difference=int(difference))
@@ -0,0 +1,24 @@
+import glob
+import os
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.webp')
+
+
+def find_images(inputs):
+    """
+    Expand directories and glob patterns into a sorted list of image files.
+    """
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            candidates = [os.path.join(item, name) for name in os.listdir(item)]
+        else:
+            candidates = glob.glob(item, recursive=True)
+        files += [path for path in candidates
+                  if os.path.isfile(path) and os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS]
+    return sorted(set(files))
+
+
+def output_path(path, output_dir, extension=None):
+    name, ext = os.path.splitext(os.path.basename(path))
+    return os.path.join(output_dir, name + (('.' + extension.lstrip('.')) if extension else ext))
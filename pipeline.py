@@ -0,0 +1,134 @@
+import queue
+import threading as td
+
+_DONE = object()
+
+
+class Failure:
+    """
+    Carried through the remaining stages in place of an item whose stage raised.
+    """
+
+    def __init__(self, item, error):
+        self.item = item
+        self.error = error
+
+
+class Stage:
+    def __init__(self, fn, workers=1, queue_depth=4, batch_key=None, max_batch=1):
+        """
+        :param fn: callable taking one item and returning the item for the next stage.
+            When batch_key is given or max_batch > 1 it takes a list of items and returns a list of the same length.
+        :param workers: threads running fn.
+        :param queue_depth: items allowed to wait in front of this stage, bounds memory usage.
+        :param batch_key: callable, only items with equal keys are passed to fn together.
+        :param max_batch: most items passed to fn in one call. Items already waiting in the queue
+            are grouped, a worker never waits for a batch to fill up.
+        """
+        self.fn = fn
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.batched = batch_key is not None or max_batch > 1
+        self.batch_key = batch_key or (lambda item: None)
+        self.max_batch = max_batch
+
+
+class Pipeline:
+    """
+    Runs items through a chain of stages, each with its own threads and a bounded input queue,
+    so decoding, inference and encoding of different items overlap.
+    """
+
+    def __init__(self, stages):
+        self.stages = stages
+
+    def run(self, items):
+        """
+        :return:
+            stage outputs (or Failure) in the order of items.
+        """
+        items = list(items)
+        queues = [queue.Queue(maxsize=max(1, stage.queue_depth)) for stage in self.stages]
+        results = [None] * len(items)
+        threads = []
+
+        for i, stage in enumerate(self.stages):
+            out = queues[i + 1] if i + 1 < len(self.stages) else None
+            next_workers = self.stages[i + 1].workers if out is not None else 0
+            remaining = [stage.workers]
+            lock = td.Lock()
+            for _ in range(stage.workers):
+                thread = td.Thread(target=self._work, daemon=True,
+                                   args=(stage, queues[i], out, next_workers, remaining, lock, results))
+                thread.start()
+                threads.append(thread)
+
+        for index, item in enumerate(items):
+            queues[0].put((index, item))
+        for _ in range(self.stages[0].workers):
+            queues[0].put(_DONE)
+
+        for thread in threads:
+            thread.join()
+        return results
+
+    @staticmethod
+    def _take(stage, in_queue):
+        """
+        Block for one task, then drain whatever else is already waiting, up to one batch.
+        """
+        tasks = [in_queue.get()]
+        while stage.max_batch > 1 and tasks[-1] is not _DONE and len(tasks) < stage.max_batch:
+            try:
+                tasks.append(in_queue.get_nowait())
+            except queue.Empty:
+                break
+        return tasks
+
+    @staticmethod
+    def _apply(stage, tasks):
+        if not stage.batched:
+            index, item = tasks[0]
+            try:
+                return [(index, stage.fn(item))]
+            except Exception as e:
+                return [(index, Failure(item, e))]
+
+        groups = {}
+        for task in tasks:
+            groups.setdefault(stage.batch_key(task[1]), []).append(task)
+        done = []
+        for group in groups.values():
+            for start in range(0, len(group), stage.max_batch):
+                chunk = group[start:start + stage.max_batch]
+                try:
+                    outputs = stage.fn([item for _, item in chunk])
+                except Exception as e:
+                    outputs = [Failure(item, e) for _, item in chunk]
+                done += [(index, output) for (index, _), output in zip(chunk, outputs)]
+        return done
+
+    @staticmethod
+    def _work(stage, in_queue, out_queue, next_workers, remaining, lock, results):
+        finished = False
+        while not finished:
+            tasks = Pipeline._take(stage, in_queue)
+            if tasks[-1] is _DONE:
+                tasks.pop()
+                finished = True
+
+            failed = [task for task in tasks if isinstance(task[1], Failure)]
+            pending = [task for task in tasks if not isinstance(task[1], Failure)]
+            done = failed + (Pipeline._apply(stage, pending) if pending else [])
+            for index, item in done:
+                if out_queue is None:
+                    results[index] = item
+                else:
+                    out_queue.put((index, item))
+
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last and out_queue is not None:
+            for _ in range(next_workers):
+                out_queue.put(_DONE)
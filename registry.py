@@ -0,0 +1,97 @@
+import hashlib
+import logging
+import os
+import threading as td
+from collections import OrderedDict
+
+
+def file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class ModelRegistry:
+    """
+    Keeps recently used models loaded, keyed by model path and file hash,
+    and closes the least recently used ones when over capacity.
+    """
+
+    def __init__(self, capacity=3, max_bytes=None):
+        """
+        :param capacity: most models kept loaded.
+        :param max_bytes: most model file bytes kept loaded, a rough stand-in for their memory usage.
+        """
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self._models = OrderedDict()
+        self._hashes = {}
+        self._lock = td.RLock()
+
+    def key(self, path):
+        """
+        :return:
+            (path, sha1), the file is only hashed again when its size or mtime changed.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self._lock:
+            cached = self._hashes.get(path)
+        if cached is None or cached[:2] != (stat.st_mtime, stat.st_size):
+            cached = (stat.st_mtime, stat.st_size, file_hash(path))
+            with self._lock:
+                self._hashes[path] = cached
+        return path, cached[2]
+
+    def get(self, path, load):
+        """
+        :param load: callable taking the model file content and returning an object with close().
+        :return:
+            the loaded model, from cache when the same file was loaded before.
+        """
+        key = self.key(path)
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key][0]
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        model = load(data)
+
+        with self._lock:
+            if key in self._models:  # loaded by another thread meanwhile
+                model.close()
+                self._models.move_to_end(key)
+                return self._models[key][0]
+            self._models[key] = (model, len(data))
+            self._evict()
+        return model
+
+    def _evict(self):
+        while len(self._models) > 1 and (len(self._models) > self.capacity or
+                                         (self.max_bytes and self.size() > self.max_bytes)):
+            (path, _), (model, _) = self._models.popitem(last=False)
+            logging.info("unload model '%s'", path)
+            model.close()
+
+    def size(self):
+        with self._lock:
+            return sum(size for _, size in self._models.values())
+
+    def __len__(self):
+        return len(self._models)
+
+    def __contains__(self, path):
+        try:
+            return self.key(path) in self._models
+        except OSError:
+            return False
+
+    def clear(self):
+        with self._lock:
+            while self._models:
+                _, (model, _) = self._models.popitem()
+                model.close()
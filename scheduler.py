@@ -0,0 +1,124 @@
+import heapq
+import itertools
+import threading as td
+from concurrent.futures import Future
+
+# lower runs first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 5
+PRIORITY_BATCH = 10
+
+
+class Request:
+    def __init__(self, image, options, priority=PRIORITY_NORMAL, batch_key=None):
+        """
+        :param options: keyword arguments for the function the Scheduler runs.
+        :param batch_key: requests with equal keys may run in one call, None never merges.
+        """
+        self.image = image
+        self.options = options
+        self.priority = priority
+        self.batch_key = batch_key
+        self.future = Future()
+
+
+class Scheduler:
+    """
+    Runs queued requests on worker threads, most urgent first. Requests waiting with the
+    same batch key as the one picked are merged into the same call, up to max_batch.
+    """
+
+    def __init__(self, run, workers=1, max_batch=4):
+        """
+        :param run: callable taking a list of Requests and returning a result or an exception for each.
+        :param workers: threads calling run.
+        :param max_batch: most requests passed to run at once.
+        """
+        self.run = run
+        self.max_batch = max_batch
+        self._heap = []
+        self._order = itertools.count()
+        self._condition = td.Condition()
+        self._closed = False
+        self._busy = 0
+        self._threads = [td.Thread(target=self._work, daemon=True, name='scheduler-%d' % i) for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, request):
+        """
+        :return:
+            request.future
+        """
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("scheduler is closed")
+            heapq.heappush(self._heap, (request.priority, next(self._order), request))
+            self._condition.notify()
+        return request.future
+
+    def queue_depth(self):
+        with self._condition:
+            return len(self._heap)
+
+    def busy(self):
+        """
+        :return:
+            requests being run right now.
+        """
+        with self._condition:
+            return self._busy
+
+    def _take(self):
+        with self._condition:
+            while not self._heap and not self._closed:
+                self._condition.wait()
+            if not self._heap:
+                return None
+            _, _, first = heapq.heappop(self._heap)
+            batch = [first]
+            if first.batch_key is not None and self.max_batch > 1:
+                rest = []
+                for entry in sorted(self._heap):
+                    if len(batch) < self.max_batch and entry[2].batch_key == first.batch_key:
+                        batch.append(entry[2])
+                    else:
+                        rest.append(entry)
+                self._heap = rest  # sorted, so still a heap
+            batch = [request for request in batch if request.future.set_running_or_notify_cancel()]
+            self._busy += len(batch)
+            return batch
+
+    def _work(self):
+        while True:
+            batch = self._take()
+            if batch is None:
+                return
+            if not batch:
+                continue
+            try:
+                results = self.run(batch)
+            except Exception as e:
+                results = [e] * len(batch)
+            with self._condition:
+                self._busy -= len(batch)
+            for request, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    request.future.set_exception(result)
+                else:
+                    request.future.set_result(result)
+
+    def close(self, wait=True):
+        """
+        Cancel the requests still waiting and stop the workers once the running ones are done.
+        """
+        with self._condition:
+            self._closed = True
+            pending, self._heap = self._heap, []
+            self._condition.notify_all()
+        for _, _, request in pending:
+            request.future.cancel()
+        if wait:
+            for thread in self._threads:
+                if thread is not td.current_thread():
+                    thread.join()
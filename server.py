@@ -0,0 +1,298 @@
+import http.client
+import json
+import logging
+import os
+import socket
+import socketserver
+import stat
+import threading as td
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+from scheduler import PRIORITY_NORMAL
+
+DEFAULT_ADDRESS = '127.0.0.1:8765'
+
+
+def parse_address(address):
+    """
+    :param address: 'host:port', ':port', or the path of a Unix socket.
+    :return:
+        (host, port) or the socket path.
+    """
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit() and '/' not in address:
+        return host or '127.0.0.1', int(port)
+    return address
+
+
+class _QueueFull(Exception):
+    pass
+
+
+def _flag(value):
+    """
+    Query string denoise option: '', '1' or 'true' for the default preset, '0' or 'false' for none, or a preset name.
+    """
+    if value is None or value.lower() in ('0', 'false', 'no'):
+        return False
+    if value.lower() in ('', '1', 'true', 'yes'):
+        return True
+    return value
+
+
+class InferenceServer:
+    """
+    Keeps an Enhancer and its session loaded and serves enhance requests from local clients
+    over HTTP, on localhost or a Unix socket. Concurrent requests go through Enhancer.submit,
+    so same-sized images from different clients share session calls.
+
+    GET  /health                    -> JSON status, model and queue depth.
+    POST /enhance?denoise=&denoise_after=&width=&height=&tile_size=&priority=&format=png
+         with an encoded image      -> the encoded result.
+    """
+
+    def __init__(self, enhancer, address=DEFAULT_ADDRESS, max_queue=64):
+        """
+        :param enhancer: Enhancer with a model loaded.
+        :param max_queue: requests allowed to wait, more are answered with 503.
+        """
+        self.enhancer = enhancer
+        self.address = parse_address(address)
+        self.max_queue = max_queue
+        self.started = time.time()
+        self.served = 0
+        self.failed = 0
+        self._lock = td.Lock()
+        if isinstance(self.address, tuple):
+            self._httpd = _ThreadingHTTPServer(self.address, _Handler)
+        else:
+            self._httpd = _UnixHTTPServer(self.address, _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.service = self
+
+    def health(self):
+        return {
+            'status': 'ok' if self.enhancer.model_available() else 'no model',
+            'model': self.enhancer.model_path,
+            'model_hash': self.enhancer.model_hash,
+            'backend': self.enhancer.backend_name,
+            'queue_depth': self.enhancer.queue_depth(),
+            'max_queue': self.max_queue,
+            'served': self.served,
+            'failed': self.failed,
+            'uptime': time.time() - self.started,
+            'metrics': self.enhancer.metrics.summary(),
+        }
+
+    def count(self, success):
+        with self._lock:
+            if success:
+                self.served += 1
+            else:
+                self.failed += 1
+
+    def enhance(self, data, query):
+        """
+        :return:
+            (encoded result, pixels)
+        """
+        import cv2
+        import numpy as np
+
+        from enhancer import resize_image
+
+        if self.enhancer.queue_depth() >= self.max_queue:
+            raise _QueueFull("%d requests waiting" % self.enhancer.queue_depth())
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError("can't decode image")
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        width, height = int(query.get('width') or 0), int(query.get('height') or 0)
+        if width or height:
+            image = resize_image(image, width, height)
+        h, w = image.shape[:2]
+        image = image[h % 4:, w % 4:]  # cropped like batch_process does, so both give the same output
+
+        future = self.enhancer.submit(image, denoise=_flag(query.get('denoise')),
+                                      denoise_after=_flag(query.get('denoise_after')),
+                                      tile_size=int(query['tile_size']) if query.get('tile_size') else None,
+                                      priority=int(query.get('priority', PRIORITY_NORMAL)))
+        result_img = future.result()
+        ok, encoded = cv2.imencode('.' + query.get('format', 'png').lstrip('.'),
+                                   cv2.cvtColor(result_img, cv2.COLOR_RGB2BGR))
+        if not ok:
+            raise ValueError("can't encode format '%s'" % query.get('format'))
+        return encoded.tobytes(), result_img.shape[0] * result_img.shape[1]
+
+    def serve_forever(self):
+        logging.info("serving %s on %s", self.enhancer.model_path, self.address)
+        try:
+            self._httpd.serve_forever()
+        finally:
+            self._httpd.server_close()
+            if not isinstance(self.address, tuple) and os.path.exists(self.address):
+                os.remove(self.address)
+
+    def shutdown(self):
+        self._httpd.shutdown()
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True  # what http.server.ThreadingHTTPServer does, it only exists from Python 3.7
+
+
+class _UnixHTTPServer(_ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address) and stat.S_ISSOCK(os.stat(self.server_address).st_mode):
+            os.remove(self.server_address)  # left behind by a server that didn't shut down
+        socketserver.TCPServer.server_bind(self)
+        self.server_name, self.server_port = 'localhost', 0
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'FantasticFilter'
+
+    def address_string(self):
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+    def log_message(self, format, *args):
+        logging.debug("%s %s", self.address_string(), format % args)
+
+    def _send(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status, value):
+        self._send(status, json.dumps(value).encode(), 'application/json')
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/health':
+            self._send_json(200, self.server.service.health())
+        else:
+            self._send_json(404, {'error': "unknown path '%s'" % self.path})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        data = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if url.path != '/enhance':
+            self._send_json(404, {'error': "unknown path '%s'" % self.path})
+            return
+
+        service = self.server.service
+        query = {name: values[-1] for name, values in parse_qs(url.query, keep_blank_values=True).items()}
+        try:
+            body, pixels = service.enhance(data, query)
+        except _QueueFull as e:
+            self._send_json(503, {'error': str(e)})
+        except ValueError as e:
+            service.count(False)
+            self._send_json(400, {'error': str(e)})
+        except Exception as e:
+            logging.error("enhance request failed: %s", e)
+            service.count(False)
+            self._send_json(500, {'error': str(e)})
+        else:
+            service.count(True)
+            self._send(200, body, 'application/octet-stream', {'X-Pixels': str(pixels)})
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class Client:
+    """
+    Talks to an InferenceServer. Only the standard library is imported until images are passed as arrays,
+    so scripts using it start without loading TensorFlow. Safe to share between threads.
+    """
+
+    def __init__(self, address=DEFAULT_ADDRESS, timeout=None):
+        self.address = parse_address(address)
+        self.timeout = timeout
+
+    def _request(self, method, path, body=None):
+        if isinstance(self.address, tuple):
+            connection = http.client.HTTPConnection(*self.address, timeout=self.timeout)
+        else:
+            connection = _UnixHTTPConnection(self.address, timeout=self.timeout)
+        try:
+            connection.request(method, path, body=body)
+            response = connection.getresponse()
+            data = response.read()
+        finally:
+            connection.close()
+        if response.status != 200:
+            try:
+                message = json.loads(data.decode())['error']
+            except (ValueError, KeyError):
+                message = response.reason
+            raise IOError("server answered %d: %s" % (response.status, message))
+        return response, data
+
+    def health(self):
+        return json.loads(self._request('GET', '/health')[1].decode())
+
+    def available(self):
+        try:
+            return self.health()['status'] == 'ok'
+        except OSError:
+            return False
+
+    def enhance_bytes(self, data, format='png', **options):
+        """
+        :param data: an encoded image.
+        :param options: denoise, denoise_after (bool or preset name), width, height, tile_size, priority.
+        :return:
+            (encoded result, pixels)
+        """
+        query = {'format': format}
+        for name, value in options.items():
+            if value is True:
+                value = 1
+            if value not in (None, False):
+                query[name] = value
+        response, data = self._request('POST', '/enhance?' + urlencode(query), body=data)
+        return data, int(response.getheader('X-Pixels', 0))
+
+    def enhance(self, image, **options):
+        """
+        :param image: RGB uint8 array.
+        :return:
+            the enhanced RGB array.
+        """
+        import cv2
+        import numpy as np
+
+        encoded = cv2.imencode('.png', cv2.cvtColor(image[:, :, :3], cv2.COLOR_RGB2BGR))[1].tobytes()
+        data, _ = self.enhance_bytes(encoded, 'png', **options)
+        return cv2.cvtColor(cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+
+    def enhance_file(self, path, save_path, **options):
+        """
+        :return:
+            pixels of the result.
+        """
+        with open(path, 'rb') as f:
+            data = f.read()
+        data, pixels = self.enhance_bytes(data, os.path.splitext(save_path)[1].lstrip('.') or 'png', **options)
+        with open(save_path, 'wb') as f:
+            f.write(data)
+        return pixels
@@ -0,0 +1,200 @@
+import logging
+import multiprocessing as mp
+import os
+import queue
+import tempfile
+import threading as td
+from collections import deque
+
+import numpy as np
+
+from metrics import Metrics
+
+_enhancer = None  # the Enhancer of a worker process
+
+
+def available_cores():
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:  # not Linux
+        return list(range(os.cpu_count() or 1))
+
+
+def core_groups(processes, cores=None):
+    """
+    Split cores into processes disjoint groups of nearly equal size.
+    """
+    cores = sorted(cores or available_cores())
+    processes = max(1, min(processes, len(cores)))
+    size, extra = divmod(len(cores), processes)
+    groups, start = [], 0
+    for i in range(processes):
+        stop = start + size + (i < extra)
+        groups.append(cores[start:stop])
+        start = stop
+    return groups
+
+
+def _init_worker(free_groups, groups, model_path, options):
+    global _enhancer
+    try:
+        cores = free_groups.get(timeout=1)
+    except queue.Empty:
+        # the pool replaced a dead worker after every group was handed out, its group is no longer
+        # known here, so share one instead of blocking in the initializer forever
+        cores = groups[os.getpid() % len(groups)]
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    # set before TensorFlow is imported, its OpenMP pool would size itself to the whole machine otherwise
+    os.environ['OMP_NUM_THREADS'] = str(len(cores))
+    if not options['gpu']:
+        os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+
+    from cache import ResultCache
+    from enhancer import Enhancer
+
+    options = dict(options)
+    cache_dir = options.pop('cache_dir', None)
+    warmup = options.pop('warmup', None)
+    _enhancer = Enhancer(intra_op_threads=len(cores), inter_op_threads=1,
+                         cache=ResultCache(cache_dir) if cache_dir else None, **options)
+    _enhancer.load_model(model_path, warmup=warmup)
+    logging.info("worker %d on cores %s", os.getpid(), cores)
+
+
+def scratch_root():
+    """
+    :return:
+        a memory backed directory when the system has one, so scratch files never touch the disk.
+    """
+    return '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+def _to_scratch(image, directory):
+    """
+    Copy image into a new memory-mapped file in directory.
+    :return:
+        the file path.
+    """
+    fd, path = tempfile.mkstemp(suffix='.raw', dir=directory)
+    os.close(fd)
+    if image.size:
+        mapped = np.memmap(path, dtype=np.uint8, mode='w+', shape=image.shape)
+        mapped[...] = image
+        mapped.flush()
+        del mapped
+    return path
+
+
+def _from_scratch(path, shape):
+    if not np.prod(shape):
+        return np.zeros(shape, dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode='r', shape=shape)
+
+
+def _enhance_scratch(task):
+    """
+    Enhance the image in a scratch file and return the result in a new one next to it.
+    :return:
+        (result path, shape, error)
+    """
+    path, shape, options = task
+    image = _from_scratch(path, shape)
+    result_img = _enhancer.sample(image, **options)
+    del image
+    if result_img is None:
+        return None, None, _enhancer.error_log
+    return _to_scratch(result_img, os.path.dirname(path)), result_img.shape, ''
+
+
+def _process_files(files):
+    _enhancer.empty()
+    for file in files:
+        _enhancer.add_files(file)
+    results = _enhancer.batch_process(workers=1, readers=1, writers=1)
+    _enhancer.empty()
+    return results
+
+
+class ProcessPool:
+    """
+    Worker processes with an Enhancer each, pinned to their own group of cores with matching session
+    thread counts. Several small sessions side by side use a many-core CPU better than one large session.
+    """
+
+    def __init__(self, model_path, processes=None, cores_per_process=None, gpu=False, **options):
+        """
+        :param processes: worker count, defaults to one per cores_per_process cores, or 4 cores when neither is given.
+        :param cores_per_process: cores pinned to each worker, the available cores are split evenly by default.
+        :param gpu: let the workers use the GPU, they are meant for CPU-only machines.
+        :param options: Enhancer arguments (tile_size, buckets, ...) plus cache_dir and warmup (see load_model),
+            plain values only since they are sent to the workers.
+        """
+        cores = available_cores()
+        if not processes:
+            processes = max(1, len(cores) // (cores_per_process or 4))
+        groups = core_groups(processes, cores[:processes * cores_per_process] if cores_per_process else cores)
+        self.processes = len(groups)
+        self.metrics = Metrics()
+
+        context = mp.get_context('spawn')  # a forked TensorFlow runtime isn't safe to use
+        free_groups = context.Queue()
+        for group in groups:
+            free_groups.put(group)
+        self._pool = context.Pool(self.processes, initializer=_init_worker,
+                                  initargs=(free_groups, groups, model_path, dict(options, gpu=gpu)))
+
+    def _record(self, result):
+        for stage, seconds in result.get('stages', {}).items():
+            self.metrics.record(stage, seconds)
+        return result
+
+    def map_files(self, files, chunk=4):
+        """
+        Run batch_process jobs (see Enhancer.add_files) on the workers. Each worker reads and writes
+        its own files, so no pixels go through the coordinator at all.
+        :return:
+            batch_process results in the order of files.
+        """
+        files = list(files)
+        chunks = [files[start:start + chunk] for start in range(0, len(files), chunk)]
+        results = []
+        for chunk_results in self._pool.imap(_process_files, chunks):
+            results += [self._record(result) for result in chunk_results]
+        return results
+
+    def map_images(self, images, in_flight=None, **options):
+        """
+        Enhance RGB arrays on the workers. Images and results travel through memory-mapped scratch files
+        (in /dev/shm when available) instead of being pickled, at most in_flight of them exist at a time.
+        :param options: sample() arguments.
+        :return:
+            generator of enhanced images (None on failure) in input order.
+        """
+        slots = td.Semaphore(in_flight or 2 * self.processes)
+        order = deque()
+
+        with tempfile.TemporaryDirectory(prefix='shard-', dir=scratch_root()) as directory:
+            def tasks():
+                for image in images:
+                    slots.acquire()
+                    image = np.ascontiguousarray(image[:, :, :3], dtype=np.uint8)
+                    path = _to_scratch(image, directory)
+                    order.append(path)
+                    yield path, image.shape, options
+
+            for path, shape, error in self._pool.imap(_enhance_scratch, tasks()):
+                os.remove(order.popleft())
+                slots.release()
+                if path is None:
+                    logging.error("enhancing in a worker failed: %s", error)
+                    yield None
+                    continue
+                try:
+                    yield np.array(_from_scratch(path, shape))
+                finally:
+                    os.remove(path)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
@@ -0,0 +1,92 @@
+import numpy as np
+
+
+def tile_spans(length, tile_size, overlap, multiple=1):
+    """
+    Split ``length`` into overlapping spans of at most ``tile_size``.
+    The last span is pushed back so it ends flush with the edge and keeps the full tile size.
+    :return: [(start, stop), ...]
+    """
+    tile_size = max(multiple, tile_size - tile_size % multiple)
+    overlap = overlap - overlap % multiple
+    if length <= tile_size:
+        return [(0, length)]
+    if overlap >= tile_size:
+        raise ValueError("tile overlap (%d) must be smaller than tile size (%d)" % (overlap, tile_size))
+
+    spans = []
+    start = 0
+    while True:
+        stop = min(start + tile_size, length)
+        spans.append((stop - tile_size, stop))
+        if stop == length:
+            return spans
+        start += tile_size - overlap
+
+
+def _ramp(size, overlap, head, tail, margin=0):
+    weight = np.ones(size, dtype=np.float32)
+    overlap = min(overlap, size)
+    if overlap > margin:
+        # the margin next to an inner edge saw the model's zero padding, it gets no weight at all
+        ramp = np.zeros(overlap, dtype=np.float32)
+        ramp[margin:] = np.arange(1, overlap - margin + 1, dtype=np.float32) / (overlap - margin + 1)
+        if head:
+            weight[:overlap] = np.minimum(weight[:overlap], ramp)
+        if tail:
+            weight[-overlap:] = np.minimum(weight[-overlap:], ramp[::-1])
+    return weight
+
+
+def iter_blended_rows(image, tile_size, overlap, run, multiple=1, margin=0):
+    """
+    Run ``run`` on overlapping tiles of ``image`` and feather the seams together.
+    Rows are finished band by band, so only one band of float32 accumulator is alive at a time.
+    :param image: (h, w, c) array, may be a np.memmap.
+    :param run: callable taking a (th, tw, c) tile and returning a result of the same height and width.
+    :param margin: pixels at inner tile edges dropped entirely, at least the model's receptive field radius;
+        the rest of the overlap is feathered. Must be less than half the overlap.
+    :return:
+        generator of (y, rows) where rows is a uint8 block starting at row y.
+    """
+    h, w = image.shape[:2]
+    ys = tile_spans(h, tile_size, overlap, multiple)
+    xs = tile_spans(w, tile_size, overlap, multiple)
+    if (len(ys) > 1 or len(xs) > 1) and 2 * margin >= overlap - overlap % multiple:
+        raise ValueError("tile margin (%d) must be less than half the tile overlap (%d)"
+                         % (margin, overlap - overlap % multiple))
+    carry, carry_weight = None, None
+
+    for i, (y0, y1) in enumerate(ys):
+        acc, acc_weight = None, np.zeros((y1 - y0, w, 1), dtype=np.float32)
+        wy = _ramp(y1 - y0, overlap, i > 0, i < len(ys) - 1, margin)
+
+        for j, (x0, x1) in enumerate(xs):
+            tile = run(np.ascontiguousarray(image[y0:y1, x0:x1]))
+            if acc is None:
+                acc = np.zeros((y1 - y0, w, tile.shape[2]), dtype=np.float32)
+                if carry is not None:
+                    acc[:len(carry)] += carry
+                    acc_weight[:len(carry)] += carry_weight
+            wx = _ramp(x1 - x0, overlap, j > 0, j < len(xs) - 1, margin)
+            weight = (wy[:, np.newaxis] * wx[np.newaxis, :])[..., np.newaxis]
+            acc[:, x0:x1] += tile * weight
+            acc_weight[:, x0:x1] += weight
+
+        next_y0 = ys[i + 1][0] if i + 1 < len(ys) else y1
+        done = next_y0 - y0
+        rows = acc[:done] / acc_weight[:done]
+        yield y0, np.clip(np.rint(rows), 0, 255).astype(np.uint8)
+        carry, carry_weight = acc[done:], acc_weight[done:]
+
+
+def blend_tiles(image, tile_size, overlap, run, multiple=1, margin=0):
+    """
+    Tiled counterpart of ``run(image)``; see iter_blended_rows.
+    """
+    result = None
+    for y, rows in iter_blended_rows(image, tile_size, overlap, run, multiple, margin):
+        if result is None:
+            result = np.empty((image.shape[0], image.shape[1], rows.shape[2]), dtype=np.uint8)
+        result[y:y + len(rows)] = rows
+    return result
@@ -0,0 +1,218 @@
+import logging
+import queue
+import threading as td
+import time
+from collections import deque
+
+import cv2
+
+from denoise import PRESETS, denoise_image, resolve_preset
+from enhancer import resize_image
+
+_DONE = object()
+
+
+def _prefetch(iterable, depth):
+    """
+    Iterate iterable on a background thread, keeping at most depth items ahead of the consumer.
+    """
+    items = queue.Queue(maxsize=max(1, depth))
+    error = []
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put(item)
+        except Exception as e:
+            error.append(e)
+        finally:
+            items.put(_DONE)
+
+    td.Thread(target=produce, daemon=True).start()
+    while True:
+        item = items.get()
+        if item is _DONE:
+            break
+        yield item
+    if error:
+        raise error[0]
+
+
+def read_frames(source, resize=None):
+    """
+    :param source: a video file, a camera index or a numbered frame sequence such as 'frames/%05d.png'.
+    :return:
+        generator of BGR frames.
+    """
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise IOError("can't open video '%s'" % source)
+    try:
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            yield resize_image(frame, *resize) if resize else frame
+    finally:
+        capture.release()
+
+
+def temporal_denoise(frames, window=5, preset='standard'):
+    """
+    Denoise every frame together with its neighbours using fastNlMeansDenoisingColoredMulti.
+    Only window frames are buffered, the window shrinks at both ends of the clip.
+    :param preset: name from denoise.PRESETS, presets that aren't nlmeans have no temporal
+        variant and denoise each frame on its own.
+    """
+    algorithm, params = PRESETS[preset]
+    if algorithm != 'nlmeans':
+        for frame in frames:
+            yield denoise_image(frame, preset)
+        return
+
+    half = window // 2
+    buffer = deque()
+    first = 0  # index of buffer[0] in the clip
+    pending = 0  # index of the next frame to denoise
+    h, h_color, template_size, search_size = (params[k] for k in ('h', 'h_color', 'template_size', 'search_size'))
+
+    def denoise(index):
+        index -= first
+        radius = min(half, index, len(buffer) - 1 - index)
+        if radius == 0:
+            return cv2.fastNlMeansDenoisingColored(buffer[index], None, h, h_color, template_size, search_size)
+        return cv2.fastNlMeansDenoisingColoredMulti(list(buffer), index, 2 * radius + 1, None,
+                                                    h, h_color, template_size, search_size)
+
+    for frame in frames:
+        buffer.append(frame)
+        if first + len(buffer) - 1 >= pending + half:
+            yield denoise(pending)
+            pending += 1
+            while pending - first > half:
+                buffer.popleft()
+                first += 1
+
+    while pending < first + len(buffer):
+        yield denoise(pending)
+        pending += 1
+
+
+class _FrameWriter:
+    """
+    Encodes and writes frames on a background thread, fed through a bounded queue.
+    """
+
+    def __init__(self, target, fps, fourcc, depth, denoise_after=None, temporal_window=5):
+        self.target = target
+        self.fps = fps
+        self.fourcc = fourcc
+        self.count = 0
+        self._queue = queue.Queue(maxsize=max(1, depth))
+        self._error = None
+        self._writer = None
+        frames = self._frames()
+        if denoise_after:
+            frames = temporal_denoise(frames, temporal_window, denoise_after)
+        self._thread = td.Thread(target=self._write_all, args=(frames,), daemon=True)
+        self._thread.start()
+
+    def _frames(self):
+        while True:
+            frame = self._queue.get()
+            if frame is _DONE:
+                return
+            yield frame
+
+    def _write_all(self, frames):
+        try:
+            for frame in frames:
+                self._write(frame)
+        except Exception as e:
+            self._error = e
+            for _ in self._frames():  # keep draining so put() never blocks forever
+                pass
+        finally:
+            if self._writer is not None:
+                self._writer.release()
+
+    def _write(self, frame):
+        if '%' in self.target:
+            if not cv2.imwrite(self.target % self.count, frame):
+                raise IOError("can't write frame '%s'" % (self.target % self.count))
+        else:
+            if self._writer is None:
+                h, w = frame.shape[:2]
+                self._writer = cv2.VideoWriter(self.target, cv2.VideoWriter_fourcc(*self.fourcc), self.fps, (w, h))
+                if not self._writer.isOpened():
+                    raise IOError("can't open video writer for '%s'" % self.target)
+            self._writer.write(frame)
+        self.count += 1
+
+    def put(self, frame):
+        self._queue.put(frame)
+
+    def close(self):
+        self._queue.put(_DONE)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+
+def enhance_video(enhancer, source, target, denoise=False, denoise_after=False, resize=None, fps=None,
+                  fourcc='mp4v', temporal_window=5, queue_depth=8, batch_size=1):
+    """
+    Stream frames from source through the enhancer into target without holding the clip in memory.
+    :param source: video file or numbered frame sequence, see read_frames.
+    :param target: video file, or a numbered frame pattern such as 'out/%05d.png'.
+    :param denoise: denoise across neighbouring frames before enhancing, True for the 'fine'
+        preset or a name from denoise.PRESETS.
+    :param denoise_after: denoise across neighbouring frames after enhancing, True for the
+        'standard' preset or a name from denoise.PRESETS.
+    :param temporal_window: odd number of frames denoised together.
+    :param queue_depth: frames allowed in flight between reading, enhancing and writing.
+    :param batch_size: frames run through the session in one call.
+    :return:
+        {'frames': int, 'seconds': float, 'pixels': int}
+    """
+    if fps is None:
+        capture = cv2.VideoCapture(source)
+        fps = capture.get(cv2.CAP_PROP_FPS) or 25
+        capture.release()
+
+    denoise = resolve_preset(denoise, 'fine')
+    denoise_after = resolve_preset(denoise_after, 'standard')
+    start = time.perf_counter()
+    frames = read_frames(source, resize)
+    if denoise:
+        frames = temporal_denoise(frames, temporal_window, denoise)
+    frames = _prefetch(frames, queue_depth)
+
+    writer = _FrameWriter(target, fps, fourcc, queue_depth, denoise_after, temporal_window)
+    pixels = 0
+    try:
+        batch = []
+        for frame in frames:
+            batch.append(frame)
+            if len(batch) >= batch_size:
+                pixels += _enhance_frames(enhancer, batch, writer)
+                batch = []
+        if batch:
+            pixels += _enhance_frames(enhancer, batch, writer)
+    finally:
+        writer.close()
+
+    seconds = time.perf_counter() - start
+    logging.info("%d frames in %.2fs", writer.count, seconds)
+    return {'frames': writer.count, 'seconds': seconds, 'pixels': pixels}
+
+
+def _enhance_frames(enhancer, frames, writer):
+    timings = {}
+    with enhancer.metrics.stage('inference', timings):
+        results = enhancer.enhance_frames(frames)
+    for result_img in results:
+        writer.put(result_img)
+    pixels = sum(result_img.shape[0] * result_img.shape[1] for result_img in results)
+    enhancer.metrics.finish(timings, success=True, pixels=pixels, error='')
+    return pixels
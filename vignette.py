@@ -0,0 +1,59 @@
+import numpy as np
+
+
+class Vignette:
+    """
+    Gaussian vignette. The distance grid is cached per image shape and the mask per scale,
+    so repeated calls with the same image size only pay for the multiply.
+    """
+
+    def __init__(self):
+        self._shape = None
+        self._distance = None
+        self._scale = None
+        self._mask = None
+
+    def mask(self, shape, scale):
+        """
+        :param scale: 1 darkens the corners the most, larger values push the falloff outwards.
+        :return:
+            float32 (h, w, 1) mask.
+        """
+        h, w = shape[:2]
+        if self._shape != (h, w):
+            ys = (np.arange(h, dtype=np.float32) - h / 2.0) ** 2
+            xs = (np.arange(w, dtype=np.float32) - w / 2.0) ** 2
+            sigma_squared = ((h / 2.0) ** 2 + (w / 2.0) ** 2) / 2
+            self._distance = (ys[:, np.newaxis] + xs[np.newaxis, :]) / np.float32(sigma_squared)
+            self._shape = (h, w)
+            self._scale = None
+
+        if self._scale != scale:
+            # cropping the centre 1/scale of the base mask and stretching it back
+            # is the same gaussian with sigma multiplied by scale.
+            self._mask = np.exp(self._distance * np.float32(-1 / scale ** 2))[..., np.newaxis]
+            self._scale = scale
+        return self._mask
+
+    def apply(self, image, scale):
+        result = np.multiply(image, self.mask(image.shape, scale), dtype=np.float32)
+        return result.astype(np.uint8)
+
+
+def fit_size(shape, width, height):
+    """
+    :return:
+        (width, height) of an image of the given shape scaled down to fit in width x height.
+    """
+    h, w = shape[:2]
+    scale = min(1.0, width / w, height / h)
+    return max(1, int(w * scale)), max(1, int(h * scale))
+
+
+def downscale(image, width, height):
+    import cv2  # not imported with the module, app.py starts without OpenCV
+
+    size = fit_size(image.shape, width, height)
+    if size == (image.shape[1], image.shape[0]):
+        return image
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
@@ -0,0 +1,166 @@
+import json
+import logging
+import os
+import time
+
+from paths import find_images, output_path
+from registry import file_hash
+
+
+class Manifest:
+    """
+    Persistent record of processed files. An entry is keyed by the source path and remembers
+    the content hash, model hash and options it was produced with, so unchanged files whose
+    output still exists are skipped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                self._entries = json.load(f).get('files', {})
+
+    @staticmethod
+    def settings(model_hash, options):
+        return '%s:%s' % (model_hash, json.dumps(options, sort_keys=True))
+
+    def pending(self, path, model_hash, options, output=None):
+        """
+        :param output: where the result is written, a missing one is produced again.
+        :return:
+            (needs_work, content_hash). The file is only hashed when its size or mtime changed
+            or the model or options differ.
+        """
+        stat = os.stat(path)
+        entry = self._entries.get(os.path.abspath(path))
+        current = entry is not None and entry['settings'] == Manifest.settings(model_hash, options) and \
+            (output is None or os.path.exists(output))
+        if current and (entry['mtime'], entry['size']) == (stat.st_mtime, stat.st_size):
+            return False, entry['hash']
+
+        content_hash = file_hash(path)
+        if current and entry['hash'] == content_hash:
+            entry['mtime'], entry['size'] = stat.st_mtime, stat.st_size  # touched but unchanged
+            return False, content_hash
+        return True, content_hash
+
+    def mark(self, path, content_hash, model_hash, options, output):
+        stat = os.stat(path)
+        self._entries[os.path.abspath(path)] = {
+            'hash': content_hash,
+            'settings': Manifest.settings(model_hash, options),
+            'mtime': stat.st_mtime,
+            'size': stat.st_size,
+            'output': output,
+            'time': time.time(),
+        }
+
+    def save(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'version': 1, 'files': self._entries}, f, indent=1)
+        os.replace(temp_path, self.path)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class FolderWatcher:
+    """
+    Polls input directories and enhances new or changed images with an already loaded Enhancer,
+    recording every result in a Manifest so a restart picks up where it stopped.
+    """
+
+    def __init__(self, enhancer, inputs, output_dir, manifest, options, extension=None, interval=5., settle=2.,
+                 chunk=64, **batch_options):
+        """
+        :param inputs: directories or glob patterns to watch.
+        :param options: {'denoise': bool, 'denoise_after': bool, 'resize': (width, height)}
+        :param interval: seconds between scans.
+        :param settle: files modified more recently than this are left for the next scan, they may still be copied.
+        :param chunk: files processed between two manifest saves.
+        :param batch_options: passed on to Enhancer.batch_process.
+        """
+        self.enhancer = enhancer
+        self.inputs = inputs
+        self.output_dir = output_dir
+        self.manifest = manifest
+        self.options = options
+        self.extension = extension
+        self.interval = interval
+        self.settle = settle
+        self.chunk = chunk
+        self.batch_options = batch_options
+        self.running = False
+
+    def settings(self):
+        """
+        :return:
+            options plus the enhancer and output settings that change the result, what the manifest compares.
+        """
+        enhancer = self.enhancer
+        return dict(self.options, extension=self.extension, tile_size=enhancer.tile_size,
+                    tile_overlap=enhancer.tile_overlap, tile_margin=enhancer.tile_margin, buckets=enhancer.buckets,
+                    encode_preset=enhancer.encode_preset, backend=enhancer.backend_name)
+
+    def scan(self):
+        """
+        :return:
+            [(path, content_hash), ...] of the files that need to be processed.
+        """
+        settings = self.settings()
+        now = time.time()
+        todo = []
+        for path in find_images(self.inputs):
+            try:
+                if now - os.stat(path).st_mtime < self.settle:
+                    continue
+                needs_work, content_hash = self.manifest.pending(path, self.enhancer.model_hash, settings,
+                                                                 output_path(path, self.output_dir, self.extension))
+            except OSError as e:
+                logging.warning("skip '%s': %s", path, e)
+                continue
+            if needs_work:
+                todo.append((path, content_hash))
+        return todo
+
+    def run_once(self):
+        """
+        Process everything the last scan found.
+        :return:
+            batch_process results.
+        """
+        results = []
+        settings = self.settings()
+        todo = self.scan()
+        for start in range(0, len(todo), self.chunk):
+            chunk = todo[start:start + self.chunk]
+            self.enhancer.empty()
+            for path, _ in chunk:
+                self.enhancer.add_files(dict(self.options, path=path,
+                                             save_path=output_path(path, self.output_dir, self.extension)))
+            chunk_results = self.enhancer.batch_process(**self.batch_options)
+            for (path, content_hash), result in zip(chunk, chunk_results):
+                if result['success']:
+                    self.manifest.mark(path, content_hash, self.enhancer.model_hash, settings,
+                                       output_path(path, self.output_dir, self.extension))
+            self.manifest.save()
+            results += chunk_results
+        self.enhancer.empty()
+        return results
+
+    def run(self):
+        self.running = True
+        os.makedirs(self.output_dir, exist_ok=True)
+        while self.running:
+            results = self.run_once()
+            if results:
+                failed = sum(not result['success'] for result in results)
+                logging.info("processed %d files, %d failed", len(results), failed)
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False